@@ -12,6 +12,10 @@ from rdkit.Chem import AllChem
 from rdkit.Chem.EnumerateStereoisomers import EnumerateStereoisomers, StereoEnumerationOptions
 from rdkit.Chem.MolStandardize import rdMolStandardize
 import os
+import sys
+
+sys.path.append(os.getenv("SECSE"))
+from uitilities.mol_store import get_mol_store
 
 
 class LigPrep:
@@ -22,18 +26,27 @@ class LigPrep:
 
     def parse_infile(self):
         with open(self.infile, "r") as inf:
-            for line in inf:
-                tmp = line.strip().split("\t")
-                if len(tmp) < 2:
-                    continue
-                smi = tmp[0]
-                id1 = tmp[1]
-
-                mol = Chem.MolFromSmiles(smi)
-                if mol is None:
-                    continue
-                mol.SetProp("_Name", id1)
-                self.mol_dict[id1] = mol
+            lines = [line.strip().split("\t") for line in inf]
+        lines = [tmp for tmp in lines if len(tmp) >= 2]
+        # mols already parsed by the run
+        mol_store = get_mol_store()
+        stored = mol_store.get_mols([tmp[0] for tmp in lines]) if mol_store is not None else {}
+        parsed = {}
+        for tmp in lines:
+            smi = tmp[0]
+            id1 = tmp[1]
+
+            if smi not in stored and smi not in parsed:
+                parsed[smi] = Chem.MolFromSmiles(smi)
+            # copy, ids may share the same smiles
+            mol = stored[smi] if smi in stored else parsed[smi]
+            if mol is None:
+                continue
+            mol = Chem.Mol(mol)
+            mol.SetProp("_Name", id1)
+            self.mol_dict[id1] = mol
+        if mol_store is not None:
+            mol_store.add_mols({k: v for k, v in parsed.items() if v is not None})
 
     def setero(self, mol, onlyUnassigned=True):
         if onlyUnassigned:
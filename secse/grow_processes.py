@@ -6,6 +6,7 @@
 @time: 2021/11/17/13:49
 """
 import csv
+import json
 import shutil
 import os
 import subprocess
@@ -13,11 +14,20 @@ import pandas as pd
 import rdkit
 import configparser
 from evaluate.glide_docking import dock_by_glide
-from growing.mutation.mutation import mutation_df
+from growing.mutation.mutation import mutation_df, mutation_frame, count_rules, add_filter_yield, get_spacer_ratio
+from growing.filter import filter_df, pool_filter
 from scoring.ranking import Ranking
-from scoring.diversity_score import clustering
+from scoring.diversity_score import clustering, lsh_clustering
 from scoring.docking_score_prediction import prepare_files
 from evaluate.vina_docking import dock_by_py_vina
+from growing.mutation.seed_cache import SeedCache
+from growing.verdict_cache import VerdictCache
+from growing.mutation.building_block import BuildingBlocks
+from growing.mutation.rule_scheduler import RuleScheduler
+from uitilities.mol_store import MolStore, MOL_STORE_ENV
+from uitilities.seen_set import SeenSet
+from uitilities.wash_mol import docking_key
+from pandarallel import pandarallel
 import time
 
 rdkit.RDLogger.DisableLog("rdApp.*")
@@ -46,11 +56,67 @@ class Grow(object):
         self.dl_mode = dl_mode
 
         self.config_path = config_path
+        config = configparser.ConfigParser()
+        config.read(self.config_path)
+        self.stream_mutation = config.getboolean("mutation", "stream_output", fallback=False)
+        self.profile_rules = config.getboolean("mutation", "profile_rules", fallback=False)
+        self.lazy_mutation = config.getboolean("mutation", "lazy", fallback=False)
+        self.lazy_headroom = config.getfloat("mutation", "lazy_headroom", fallback=10)
+        self.in_memory = config.getboolean("DEFAULT", "in_memory", fallback=False)
+        self.docking_dedup = config.getboolean("mutation", "docking_dedup", fallback=False)
+        self.persist_intermediate = config.getboolean("DEFAULT", "persist_intermediate", fallback=False)
+        # exact: max-min picking on a sample; lsh: approximate picking scaling to the whole filter output
+        self.picker = config.get("clustering", "picker", fallback="exact").lower()
+        self.sample_size = config.getint("clustering", "sample_size", fallback=500000)
+        self.lsh_bands = config.getint("clustering", "lsh_bands", fallback=6)
+        self.lsh_rows = config.getint("clustering", "lsh_rows", fallback=3)
+        if self.picker not in ["exact", "lsh"]:
+            raise ValueError("picker should be exact or lsh, got {}.".format(self.picker))
+        if not 1 <= self.lsh_rows <= 6:
+            raise ValueError("lsh_rows should be between 1 and 6, got {}.".format(self.lsh_rows))
+        self.seen_set = None
+        if config.getboolean("mutation", "seen_filter", fallback=False):
+            self.seen_set = SeenSet(os.path.join(self.workdir, "seen"),
+                                    config.getint("mutation", "seen_capacity", fallback=20000000))
+            self.seen_set.truncate(self.gen)
+        self.rule_scheduler = None
+        self.rule_weights = {}
+        if config.getboolean("mutation", "adaptive_rules", fallback=False):
+            self.rule_scheduler = RuleScheduler(os.path.join(self.workdir, "rule_scheduler.json"),
+                                                config.getfloat("mutation", "adaptive_decay", fallback=0.8),
+                                                config.getfloat("mutation", "adaptive_min_weight", fallback=0.1))
+            self.rule_scheduler.truncate(self.gen)
+        # caches shared between runs
+        self.cache_dir = config.get("DEFAULT", "cache_dir", fallback=os.path.join(os.getenv("SECSE"), "cache"))
+        self.seed_cache = None
+        if config.getboolean("mutation", "seed_cache", fallback=False):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.seed_cache = SeedCache(os.path.join(self.cache_dir, "seed_mutation.db"),
+                                        config.getint("mutation", "seed_cache_size", fallback=100000))
+        # parsed mols of this run, shared with LigPrep and ranking
+        self.mol_store = None
+        if config.getboolean("DEFAULT", "mol_store", fallback=False):
+            os.makedirs(self.workdir, exist_ok=True)
+            self.mol_store = MolStore(os.path.join(self.workdir, "mol_store.db"))
+            self.mol_store.conn()
+            os.environ[MOL_STORE_ENV] = self.mol_store.path
+        self.verdict_cache = None
+        if config.getboolean("filter", "verdict_cache", fallback=False):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.verdict_cache = VerdictCache(os.path.join(self.cache_dir, "filter_verdict.db"),
+                                              config.getint("filter", "verdict_cache_size", fallback=5000000))
+        # building blocks for two component rules, indexed once and shared between runs
+        self.building_blocks = None
+        building_blocks = config.get("mutation", "building_blocks", fallback="")
+        if building_blocks:
+            self.building_blocks = BuildingBlocks(building_blocks, config.get("mutation", "reaction_rules"),
+                                                  self.cache_dir,
+                                                  config.getint("mutation", "max_partners", fallback=20),
+                                                  self.cpu_num)
 
         self.lig_sdf = None
         self.winner_df = None
         self.winner_path = None
-        self._generation_dir = None
         self._filter_df = None
         self._dock_df = None
         self._sampled_df = None
@@ -59,6 +125,8 @@ class Grow(object):
     def docking_sh(self, step):
         start = time.time()
         os.makedirs(self.workdir_now, exist_ok=True)
+        if self.mol_store is not None:
+            self.mol_store.add_smi_file(self.mols_smi)
 
         if "vina" in self.docking_program:
             self.docking_vina(step)
@@ -103,6 +171,12 @@ class Grow(object):
         self.winner_df[["smiles_gen_" + str(self.gen), "id_gen_" + str(self.gen)]].to_csv(self.winner_path, sep="\t",
                                                                                           index=False,
                                                                                           quoting=csv.QUOTE_NONE)
+        if self.rule_scheduler is not None and self.gen > 0 and self._dock_df is not None:
+            # reward rule families whose products improved docking score or were selected as seeds
+            self.rule_scheduler.update(self.gen, self._dock_df["id_gen_" + str(self.gen)],
+                                       ranking.docked_df["id_find_parent"],
+                                       self.winner_df["id_find_parent_gen_" + str(self.gen)],
+                                       dict(zip(self._dock_df["id_gen_" + str(self.gen)], self._dock_df["type"])))
 
     def dl_pre(self, step):
         print("Step {}.1: Building deep learning models...".format(str(step)))
@@ -129,6 +203,123 @@ class Grow(object):
             subprocess.check_output(" ".join(merge_cmd), shell=True, stderr=subprocess.STDOUT)
             self.workdir_now = os.path.join(self.workdir, "generation_{}".format(self.gen))
 
+    def mutate_filter_files(self):
+        header = mutation_df(self.winner_df, self.workdir, self.cpu_num, self.gen, self.stream_mutation,
+                             self.seen_set, self.seed_cache, self.profile_rules, self.config_path,
+                             self.building_blocks)
+        if self.seen_set is not None:
+            self.seen_set.add_file(os.path.join(self.workdir_now, "mutation.csv"), self.gen)
+        generation_path = os.path.join(self.workdir_now, "generation")
+
+        cmd_cat = "cat {} > {}".format(os.path.join(self.workdir_now, "mutation.csv"),
+                                       generation_path + ".raw")
+        subprocess.check_output(cmd_cat, shell=True, stderr=subprocess.STDOUT)
+        cmd_dedup = "awk -F',' '!seen[$(NF-4)]++' " + generation_path + ".raw > " + generation_path + ".csv"
+        subprocess.check_output(cmd_dedup, shell=True, stderr=subprocess.STDOUT)
+        filter_in = count_rules(generation_path + ".csv") if self.profile_rules else None
+        # filter
+        print("Step 2: Filtering all mutated mols")
+        time1 = time.time()
+        passed = pool_filter(generation_path + ".csv", os.path.join(self.workdir_now, "filter.csv"), self.gen,
+                             self.config_path, self.cpu_num,
+                             desc_path=os.path.join(self.workdir_now, "descriptors.csv"),
+                             verdict_cache=self.verdict_cache,
+                             funnel_path=os.path.join(self.workdir_now, "filter_funnel.json"))
+        print("{} mols passed the filter.".format(passed))
+        for i in ["mutation.csv", "mutation.raw", "generation.raw"]:
+            os.remove(os.path.join(self.workdir_now, i))
+        time2 = time.time()
+        print("Filter runtime: {:.2f} min.".format((time2 - time1) / 60))
+
+        self._filter_df = pd.read_csv(os.path.join(self.workdir_now, "filter.csv"), header=None)
+        self._filter_df.columns = header + ["flag"]
+        if self.profile_rules:
+            add_filter_yield(self.workdir_now, filter_in,
+                             self._filter_df["reaction_id_gen_" + str(self.gen)].value_counts().to_dict())
+
+    def mutate_filter_in_memory(self):
+        # mutation and filter hand DataFrames over directly, intermediate files are only written on request
+        generation_df = mutation_frame(self.winner_df, self.workdir, self.cpu_num, self.gen, self.seen_set,
+                                       self.seed_cache, self.profile_rules, config_path=self.config_path,
+                                       building_blocks=self.building_blocks)
+        if self.seen_set is not None:
+            self.seen_set.add_many(generation_df["smiles_gen_" + str(self.gen)], self.gen)
+            self.seen_set.save()
+        if self.persist_intermediate:
+            generation_df.to_csv(os.path.join(self.workdir_now, "generation.csv"), index=False, header=False)
+        # filter
+        print("Step 2: Filtering all mutated mols")
+        time1 = time.time()
+        generation_df["flag"] = filter_df(generation_df, "smiles_gen_" + str(self.gen), self.gen, self.config_path,
+                                          self.cpu_num, self.verdict_cache,
+                                          os.path.join(self.workdir_now, "filter_funnel.json"))
+        time2 = time.time()
+        print("Filter runtime: {:.2f} min.".format((time2 - time1) / 60))
+        if self.persist_intermediate:
+            generation_df.to_csv(os.path.join(self.workdir_now, "filter_flag.csv"), index=False)
+        self._filter_df = generation_df[generation_df["flag"] == "PASS"].reset_index(drop=True)
+        if self.profile_rules:
+            add_filter_yield(self.workdir_now,
+                             generation_df["reaction_id_gen_" + str(self.gen)].value_counts().to_dict(),
+                             self._filter_df["reaction_id_gen_" + str(self.gen)].value_counts().to_dict())
+
+    def mutate_filter_lazy(self):
+        # enumerate only as many products passing the filter as sampling needs, with headroom for clustering
+        budget = min(int(self.num_per_gen * self.lazy_headroom), self.sample_size)
+        print("Step 2: Filtering mutated mols on demand, budget {}".format(budget))
+        time1 = time.time()
+        generation_df = mutation_frame(self.winner_df, self.workdir, self.cpu_num, self.gen, self.seen_set,
+                                       self.seed_cache, self.profile_rules, budget, self.config_path,
+                                       self.rule_weights, self.get_spacer_ratio(), self.building_blocks)
+        if self.seen_set is not None:
+            self.seen_set.add_many(generation_df["smiles_gen_" + str(self.gen)], self.gen)
+            self.seen_set.save()
+        if self.persist_intermediate:
+            generation_df.to_csv(os.path.join(self.workdir_now, "generation.csv"), index=False, header=False)
+        # products are filtered during mutation, only the kept parent mols are left
+        parent = generation_df["reaction_id_gen_" + str(self.gen)] == "Na-Na-Na"
+        generation_df["flag"] = "PASS"
+        generation_df.loc[parent, "flag"] = filter_df(generation_df[parent], "smiles_gen_" + str(self.gen),
+                                                      self.gen, self.config_path, self.cpu_num,
+                                                      self.verdict_cache)
+        time2 = time.time()
+        print("Mutation and filter runtime: {:.2f} min.".format((time2 - time1) / 60))
+        self._filter_df = generation_df[generation_df["flag"] == "PASS"].reset_index(drop=True)
+
+    def get_spacer_ratio(self):
+        if self.rule_scheduler is not None:
+            return self.rule_scheduler.spacer_ratio(self.gen, self.rule_weights)
+        return get_spacer_ratio(self.gen)
+
+    def sample_weights(self, df):
+        # priority of each mutation, scaled by the weight of its rule family in adaptive mode
+        weights = df["priority_gen_" + str(self.gen)].astype(float)
+        if self.rule_weights:
+            weights = weights * df["type"].map(self.rule_weights).fillna(1)
+        return weights
+
+    def dedup_docking_identity(self):
+        """
+        keep one molecule per docking identity, the one with the least assigned stereo,
+        tautomers, protomers and stereoisomers are expanded to the same species by LigPrep anyway
+        """
+        smi = "smiles_gen_" + str(self.gen)
+        before = self._filter_df.shape[0]
+        if before > 1:
+            pandarallel.initialize(verbose=0, nb_workers=self.cpu_num)
+            keys = self._filter_df[smi].parallel_apply(docking_key)
+        else:
+            keys = self._filter_df[smi].apply(docking_key)
+        stereo = self._filter_df[smi].str.count(r"@|/|\\")
+        order = stereo.sort_values(kind="stable").index
+        kept = keys.loc[order].drop_duplicates(keep="first").index.sort_values()
+        self._filter_df = self._filter_df.loc[kept].reset_index(drop=True)
+        after = self._filter_df.shape[0]
+        ratio = round(1 - after / before, 4) if before else 0
+        print("Docking identity dedup: {} of {} mols kept, collapse ratio {}.".format(after, before, ratio))
+        with open(os.path.join(self.workdir_now, "docking_dedup.json"), "w") as f:
+            json.dump({"before": before, "after": after, "collapse_ratio": ratio}, f, indent=2)
+
     def grow(self):
         print("\n{}\nInput fragment file: {}".format("*" * 66, self.mols_smi))
         print("Target grid file: {}".format(self.target))
@@ -151,40 +342,27 @@ class Grow(object):
             os.makedirs(self.workdir_now, exist_ok=True)
             self.winner_df.to_csv(os.path.join(self.workdir_now, "seed_fragments.smi"), sep="\t", index=False,
                                   quoting=csv.QUOTE_NONE)
+            if self.rule_scheduler is not None:
+                self.rule_weights = self.rule_scheduler.sample_weights(self.gen)
+                print("Rule family weights: {}".format(
+                    ", ".join("{}: {:.2f}".format(k, v) for k, v in sorted(self.rule_weights.items()))))
             # mutation
             print("Step 1: Mutation")
 
-            self._generation_dir = os.path.join(self.workdir_now, "generation_split_by_seed")
             self.winner_df = self.winner_df.reset_index(drop=True)
-            header = mutation_df(self.winner_df, self.workdir, self.cpu_num, self.gen)
-            generation_path = os.path.join(self.workdir_now, "generation")
-
-            cmd_cat = "cat {} > {}".format(os.path.join(self.workdir_now, "mutation.csv"),
-                                           generation_path + ".raw")
-            subprocess.check_output(cmd_cat, shell=True, stderr=subprocess.STDOUT)
-            cmd_dedup = "awk -F',' '!seen[$(NF-4)]++' " + generation_path + ".raw > " + generation_path + ".csv"
-            subprocess.check_output(cmd_dedup, shell=True, stderr=subprocess.STDOUT)
-            if not os.path.exists(self._generation_dir):
-                os.mkdir(self._generation_dir)
-            cmd_split = "awk -F, '{print>\"" + self._generation_dir + "/\"$2\".csv\"}' " + generation_path + ".csv"
-            subprocess.check_output(cmd_split, shell=True, stderr=subprocess.STDOUT)
-            # filter
-            print("Step 2: Filtering all mutated mols")
-            time1 = time.time()
-            cmd_filter = ["sh", os.path.join(os.getenv("SECSE"), "growing", "filter_parallel.sh"), self.workdir_now,
-                          str(self.gen), self.config_path, str(self.cpu_num)]
-            cmd_filter = " ".join(cmd_filter)
-            print(cmd_filter)
-            subprocess.check_output(cmd_filter, shell=True, stderr=subprocess.STDOUT)
-            time2 = time.time()
-            print("Filter runtime: {:.2f} min.".format((time2 - time1) / 60))
+            if self.lazy_mutation:
+                self.mutate_filter_lazy()
+            elif self.in_memory:
+                self.mutate_filter_in_memory()
+            else:
+                self.mutate_filter_files()
 
             # do not sample or clustering if generated molecules less than wanted size
-            self._filter_df = pd.read_csv(os.path.join(self.workdir_now, "filter.csv"), header=None)
-            self._filter_df.columns = header + ["flag"]
             self._filter_df["type"] = self._filter_df["reaction_id_gen_" + str(self.gen)].apply(
                 lambda x: "-".join(x.split("-")[:2]))
             self._filter_df.to_csv(os.path.join(self.workdir_now, "filter.csv"), index=False)
+            if self.docking_dedup:
+                self.dedup_docking_identity()
             if self._filter_df.shape[0] <= self.num_per_gen:
                 self._dock_df = self._filter_df
                 self._dock_df.to_csv(os.path.join(self.workdir_now, "sampled.csv"), index=False)
@@ -198,35 +376,34 @@ class Grow(object):
 
                     common_df = self._filter_df.drop(spacer_df.index, axis=0)
                     # control ratio of ring with spacer based on different stage
-                    if self.gen <= 3:
-                        spacer_ratio = 0.3
-                    elif self.gen <= 7:
-                        spacer_ratio = 0.1
-                    else:
-                        spacer_ratio = 0.01
-                    sample_size = min(self._filter_df.shape[0], 500000)
+                    spacer_ratio = self.get_spacer_ratio()
+                    sample_size = min(self._filter_df.shape[0], self.sample_size)
 
                     spacer_df = spacer_df.sample(min(int(sample_size * spacer_ratio), spacer_df.shape[0]),
                                                  replace=False,
-                                                 weights="priority_gen_" + str(self.gen))
+                                                 weights=self.sample_weights(spacer_df))
 
                     common_df = common_df.sample(min(int(sample_size * (1 - spacer_ratio)), common_df.shape[0]),
                                                  replace=False,
-                                                 weights="priority_gen_" + str(self.gen))
+                                                 weights=self.sample_weights(common_df))
                     self._sampled_df = pd.concat([spacer_df, common_df], axis=0)
                     self._sampled_df.to_csv(os.path.join(self.workdir_now, "sampled.csv"), index=False)
                 else:
                     print("No cmpds generated from ring with spacer in the generation!")
-                    self._sampled_df = self._filter_df.sample(min(self._filter_df.shape[0], 500000),
+                    self._sampled_df = self._filter_df.sample(min(self._filter_df.shape[0], self.sample_size),
                                                               replace=False,
-                                                              weights="priority_gen_" + str(self.gen))
+                                                              weights=self.sample_weights(self._filter_df))
                     self._sampled_df.to_csv(os.path.join(self.workdir_now, "sampled.csv"), index=False)
 
                 print("Step 4: Clustering")
                 # clustering
                 num_clusters = int(self.num_per_gen / 5)
-                self._sampled_df = clustering(self._sampled_df, "smiles_gen_" + str(self.gen), self.gen, self.cpu_num,
-                                              num_clusters)
+                if self.picker == "lsh":
+                    self._sampled_df = lsh_clustering(self._sampled_df, "smiles_gen_" + str(self.gen), self.gen,
+                                                      self.cpu_num, num_clusters, self.lsh_bands, self.lsh_rows)
+                else:
+                    self._sampled_df = clustering(self._sampled_df, "smiles_gen_" + str(self.gen), self.gen,
+                                                  self.cpu_num, num_clusters)
 
                 # sample enough mol
                 self._dock_df = self._sampled_df.sort_values("cluster_center_dis_gen_" + str(self.gen)).groupby(
@@ -6,6 +6,11 @@
 @time: 2020/11/16/13:14
 """
 import argparse
+import copy
+import hashlib
+import json
+import math
+import multiprocessing
 import os
 import sys
 import time
@@ -13,14 +18,147 @@ import configparser
 
 sys.path.append(os.getenv("SECSE"))
 
+import pandas as pd
 import rdkit.Chem as Chem
-from rdkit.Chem.rdMolDescriptors import CalcExactMolWt, CalcNumHBD, CalcNumHBA
-from rdkit.Chem import Descriptors
-import json
 
-from uitilities.ring_tool import RingSystems
+from uitilities.filter_bundle import load_filter_bundle
+from uitilities.descriptors import DESCRIPTOR_NAMES, mol_descriptors, property_label, lipinski_violations
+from uitilities.ring_tool import ring_check
 from uitilities.substructure_filter import StructureFilter
-from uitilities.wash_mol import wash_mol, neutralize, get_rotatable_bound_num, get_rigid_body_num
+from uitilities.substructure_engine import MolScan, get_engine
+from uitilities.wash_mol import wash_mol, neutralize
+
+
+# filters built in this process, keyed by generation and config
+_FILTERS = {}
+# generation and config of the filter pool worker
+_WORKER_ARGS = None
+# verdict cache and filter key of the filter pool worker
+_WORKER_CACHE = (None, None)
+# bump when a filter stage changes its verdicts
+VERDICT_VERSION = 1
+# filter stages in the order defining the label of a molecule
+FILTER_STAGES = ["pp_filter", "custom_filter", "charge_filter", "heteroatom_filter", "substructure_filter",
+                 "ring_system_filter", "alert_filter"]
+
+
+class FilterFunnel(object):
+    """
+    molecules in, rejections per label and per stage, and time spent in each stage
+    """
+
+    def __init__(self):
+        self.molecules = 0
+        self.cached = 0
+        self.labels = {}
+        self.time = [0.0] * len(FILTER_STAGES)
+        self.tested = [0] * len(FILTER_STAGES)
+        self.rejected = [0] * len(FILTER_STAGES)
+
+    def record(self, idx, cost):
+        self.time[idx] += cost
+        self.tested[idx] += 1
+
+    def count(self, label, idx=None, cached=False):
+        # idx is the stage giving the label, None for PASS or verdicts from the cache
+        self.molecules += 1
+        self.cached += int(cached)
+        self.labels[label] = self.labels.get(label, 0) + 1
+        if idx is not None:
+            self.rejected[idx] += 1
+
+    def merge(self, other):
+        self.molecules += other.molecules
+        self.cached += other.cached
+        for k, v in other.labels.items():
+            self.labels[k] = self.labels.get(k, 0) + v
+        for i in range(len(FILTER_STAGES)):
+            self.time[i] += other.time[i]
+            self.tested[i] += other.tested[i]
+            self.rejected[i] += other.rejected[i]
+
+    def to_dict(self, gen=None):
+        return {"gen": gen, "molecules": self.molecules, "cached": self.cached,
+                "passed": self.labels.get("PASS", 0),
+                "labels": dict(sorted(self.labels.items(), key=lambda x: -x[1])),
+                "stages": {k: {"time": round(self.time[i], 4), "tested": self.tested[i],
+                               "rejected": self.rejected[i]} for i, k in enumerate(FILTER_STAGES)}}
+
+    def save(self, path, gen=None):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(gen), f, indent=2)
+
+
+def load_filter_funnel(workdir, gen=None):
+    """
+    funnel of one generation, or of all generations found in workdir keyed by generation if gen is None
+    """
+    if gen is not None:
+        with open(os.path.join(workdir, "generation_" + str(gen), "filter_funnel.json"), "r") as f:
+            return json.load(f)
+    res = {}
+    for i in sorted(os.listdir(workdir)):
+        path = os.path.join(workdir, i, "filter_funnel.json")
+        if i.startswith("generation_") and os.path.exists(path):
+            with open(path, "r") as f:
+                funnel = json.load(f)
+            res[funnel["gen"]] = funnel
+    return res
+
+
+class StageScheduler(object):
+    """
+    order filter stages by measured cost over rejection rate, the cheapest way to reject a molecule first.
+    exact mode still evaluates every earlier stage of a failure, so labels are the same as the fixed order,
+    fast mode returns the first failure found.
+    """
+
+    def __init__(self, mode, warmup=200, interval=1000):
+        self.mode = mode
+        self.warmup = warmup
+        self.interval = interval
+        self.count = 0
+        self.time = [0.0] * len(FILTER_STAGES)
+        self.tested = [0] * len(FILTER_STAGES)
+        self.rejected = [0] * len(FILTER_STAGES)
+        self.order = list(range(len(FILTER_STAGES)))
+
+    def record(self, idx, cost, rejected):
+        self.time[idx] += cost
+        self.tested[idx] += 1
+        self.rejected[idx] += int(rejected)
+
+    def update(self):
+        # reorder after warmup and then every interval molecules
+        self.count += 1
+        if self.count >= self.warmup and (self.count - self.warmup) % self.interval == 0:
+            def expected_cost(i):
+                if self.tested[i] == 0:
+                    return 0
+                return (self.time[i] / self.tested[i]) / ((self.rejected[i] + 1) / (self.tested[i] + 2))
+
+            self.order = sorted(range(len(FILTER_STAGES)), key=expected_cost)
+
+    def run(self, molfilter):
+        first = len(FILTER_STAGES)
+        label = "PASS"
+        for i in self.order:
+            if i >= first:
+                # a failure at an earlier stage is already known
+                continue
+            time1 = time.perf_counter()
+            res = next(getattr(molfilter, FILTER_STAGES[i])())
+            cost = time.perf_counter() - time1
+            self.record(i, cost, res != "PASS")
+            molfilter.funnel.record(i, cost)
+            if res != "PASS":
+                first = i
+                label = res
+                if self.mode == "fast":
+                    break
+        self.update()
+        molfilter.funnel.count(label, first if label != "PASS" else None)
+        return label
 
 
 class Filter:
@@ -28,7 +166,10 @@ class Filter:
         self.gen = int(gen)
         self.input_smiles = None
         self.mol = None
-        self.pains_smarts = None
+        self.desc = None
+        # all substructure patterns are checked by one engine, sharing the fingerprint of each mol
+        self.engine = get_engine()
+        self.scan = None
         self.strutFilter = StructureFilter()
 
         config = configparser.ConfigParser()
@@ -41,88 +182,65 @@ class Filter:
         self.heteroatom_ratio = config.getfloat("properties", "heteroatom_ratio")
         self.rotatable_bound_num = config.getint("properties", "rotatable_bound_num")
         self.rigid_body_num = config.getint("properties", "rigid_body_num")
+        # off: fixed stage order, exact/fast: adaptive stage order per process
+        self.stage_order = config.get("filter", "stage_order", fallback="off").lower()
+        self.scheduler = StageScheduler(self.stage_order) if self.stage_order in ["exact", "fast"] else None
+        self.funnel = FilterFunnel()
 
-    def load_mol(self, input_smiles):
-        self.clean()
-        self.input_smiles = input_smiles
-        self.mol = Chem.MolFromSmiles(self.input_smiles)
+    @staticmethod
+    def prepare_mol(input_smiles):
+        mol = Chem.MolFromSmiles(input_smiles)
 
         # uncharged each atom
-        if self.input_smiles.count("-") + self.input_smiles.count("+") > 0:
-            self.mol, self.input_smiles = neutralize(self.input_smiles)
+        if input_smiles.count("-") + input_smiles.count("+") > 0:
+            mol, input_smiles = neutralize(input_smiles)
+
+        if mol is None:
+            input_smiles = wash_mol(input_smiles)
+            mol = Chem.MolFromSmiles(input_smiles)
+            if mol is None:
+                input_smiles = "C"
+                mol = Chem.MolFromSmiles(input_smiles)
+        return input_smiles, mol
 
-        if self.mol is None:
-            self.input_smiles = wash_mol(self.input_smiles)
-            self.mol = Chem.MolFromSmiles(self.input_smiles)
-            if self.mol is None:
-                self.input_smiles = "C"
-                self.mol = Chem.MolFromSmiles(self.input_smiles)
+    def load_mol(self, input_smiles):
+        self.clean()
+        self.input_smiles, self.mol = self.prepare_mol(input_smiles)
+        self.scan = MolScan(self.mol)
 
     def clean(self):
         self.input_smiles = None
         self.mol = None
+        self.scan = None
+        self.desc = None
 
-    def lipinski_filter(self):
-        mol = Chem.MolFromSmiles(self.input_smiles)
-        violation_counter = 0
-
-        if CalcExactMolWt(mol) >= 500:
-            violation_counter += 1
-
-        if CalcNumHBD(mol) >= 5:
-            violation_counter += 1
+    def descriptors(self):
+        # descriptors of the loaded mol, computed by the first property based filter run and shared by the others
+        if self.desc is None:
+            self.desc = dict(zip(DESCRIPTOR_NAMES, mol_descriptors(self.mol)))
+        return self.desc
 
-        if CalcNumHBA(mol) >= 10:
-            violation_counter += 1
-
-        if Descriptors.MolLogP(mol) > 5:
-            violation_counter += 1
-
-        return violation_counter < 2
+    def lipinski_filter(self):
+        return lipinski_violations(self.descriptors()) < 2
 
     def pp_filter(self):
         """
         property filter
         """
-        mw = CalcExactMolWt(self.mol)
-
-        if mw > self.MW:
-            yield "MW"
-        if self.gen > 3:
-            if 81 > mw:
-                yield "MW"
-        if CalcNumHBD(self.mol) > 5:
-            yield "HBD"
-        if CalcNumHBA(self.mol) > 10:
-            yield "HBA"
-
-        logp = Descriptors.MolLogP(self.mol)
-        if logp < self.logP_lower or logp > self.logP_upper:
-            yield "cLogP"
-
-        if Descriptors.TPSA(self.mol) > 200:
-            yield "TPSA"
-        if get_rotatable_bound_num(self.mol) > self.rotatable_bound_num:
+        label = property_label(self.descriptors(), self.MW, self.logP_lower, self.logP_upper, self.gen)
+        if label != "PASS":
+            yield label
+        if self.engine.rotatable_num(self.scan, max(self.rotatable_bound_num + 1, 1)) > self.rotatable_bound_num:
             # rotatable bound customized @dalong
             yield "Rotatable Bound"
-        if get_rigid_body_num(self.mol) > self.rigid_body_num:
+        if self.engine.rigid_num(self.scan, max(self.rigid_body_num + 1, 1)) > self.rigid_body_num:
             # rotatable bound customized @dalong
             yield "Rigid Body"
         yield "PASS"
 
-    def load_pains_filter(self):
-        # read smarts for pains
-        with open(os.path.join(os.getenv("SECSE"), 'growing/pains_smarts.json')) as f:
-            data = json.load(f)
-        pains_smarts = dict((k, Chem.MolFromSmarts(v)) for k, v in data.items())
-        self.pains_smarts = pains_smarts
-
     def alert_filter(self):
-        self.load_pains_filter()
-        for name in self.pains_smarts:
-            sma = self.pains_smarts[name]
-            if self.mol.HasSubstructMatch(sma):
-                yield "PAINS"
+        if self.engine.pains_hit(self.scan):
+            yield "PAINS"
         yield "PASS"
 
     def element_filter(self):
@@ -138,11 +256,10 @@ class Filter:
 
     def substructure_filter(self):
         # self.element_filter()
-        yield self.strutFilter.sfilter(self.mol)
+        yield self.strutFilter.sfilter(self.mol, self.scan)
 
     def ring_system_filter(self):
-        ring_sys = RingSystems(self.mol)
-        if ring_sys.ring_check():
+        if ring_check(self.mol):
             yield "PASS"
         yield "RS"
 
@@ -170,17 +287,14 @@ class Filter:
         yield "PASS"
 
     def heteroatom_filter(self):
-        hetero_ratio = Chem.rdMolDescriptors.CalcNumHeteroatoms(self.mol) / self.mol.GetNumHeavyAtoms()
+        hetero_ratio = self.descriptors()["heteroatom_ratio"]
         if hetero_ratio > self.heteroatom_ratio:
             yield "heteroatom_ratio"
         else:
             yield "PASS"
 
     def charge_filter(self):
-        negative_charge = Chem.MolFromSmarts("[*-1]")
-        positive_charge = Chem.MolFromSmarts("[*+1]")
-        nc = len(self.mol.GetSubstructMatches(negative_charge))
-        pc = len(self.mol.GetSubstructMatches(positive_charge))
+        nc, pc = self.engine.charge_counts(self.scan)
         npc = nc + pc
         if npc <= 1:
             yield "PASS"
@@ -195,21 +309,208 @@ class Filter:
 
 def mol_filter(molfilter: Filter, smi):
     molfilter.load_mol(smi)
-    pass_filter = [molfilter.pp_filter(),
-                   molfilter.custom_filter(),
-                   molfilter.charge_filter(),
-                   molfilter.heteroatom_filter(),
-                   molfilter.substructure_filter(),
-                   molfilter.ring_system_filter(),
-                   molfilter.alert_filter(),
-                   ]
-    for i in pass_filter:
-        res = next(i)
+    return run_filter(molfilter)
+
+
+def run_filter(molfilter: Filter):
+    # label of the loaded mol
+    if molfilter.scheduler is not None:
+        return molfilter.scheduler.run(molfilter)
+    for i, stage in enumerate(FILTER_STAGES):
+        time1 = time.perf_counter()
+        res = next(getattr(molfilter, stage)())
+        molfilter.funnel.record(i, time.perf_counter() - time1)
         if res != "PASS":
+            molfilter.funnel.count(res, i)
             return res
+    molfilter.funnel.count("PASS")
     return "PASS"
 
 
+def filter_verdict_key(gen, config_path):
+    """
+    everything the flag of a molecule depends on besides its smiles: the property thresholds,
+    the MW floor after generation 3, fast stage order and the filter patterns
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    values = [config.getfloat("properties", i) for i in ["MW", "logP_lower", "logP_upper", "heteroatom_ratio"]]
+    values += [config.getint("properties", i) for i in ["chiral_center", "rotatable_bound_num", "rigid_body_num"]]
+    values += [int(gen) > 3, config.get("filter", "stage_order", fallback="off").lower() == "fast",
+               load_filter_bundle()["key"], VERDICT_VERSION]
+    return hashlib.md5(repr(values).encode()).hexdigest()
+
+
+def get_filter(gen, config):
+    # build a Filter only once per process
+    key = (int(gen), config)
+    if key not in _FILTERS:
+        _FILTERS[key] = Filter(gen, config)
+    return _FILTERS[key]
+
+
+def filter_df(df: pd.DataFrame, smi, gen, config, cpu_num, verdict_cache=None, funnel_path=None):
+    """
+    in memory version of file_filter, return the flag of each molecule.
+    Molecules found in verdict_cache are not filtered again.
+    The funnels of the workers are merged and written to funnel_path if given.
+    """
+    if df.shape[0] == 0:
+        return pd.Series([], dtype=object)
+    known = {}
+    if verdict_cache is not None:
+        key = filter_verdict_key(gen, config)
+        known = verdict_cache.get_many(df[smi].unique(), key)
+    flags = df[smi].map(known).astype(object)
+    todo = flags.isna()
+    funnel = FilterFunnel()
+    descriptors = {}
+    if todo.any():
+        smiles_list = df.loc[todo, smi].tolist()
+        cpu_num = cpu_num if cpu_num > 0 else multiprocessing.cpu_count()
+        size = max(1, int(math.ceil(len(smiles_list) / (cpu_num * 4))))
+        with multiprocessing.Pool(cpu_num, initializer=init_filter_worker, initargs=(gen, config)) as pool:
+            res = pool.map(filter_smiles, [smiles_list[i:i + size] for i in range(0, len(smiles_list), size)])
+        flags[todo] = [flag for chunk in res for flag in chunk[0]]
+        for _, chunk_descriptors, chunk_funnel in res:
+            descriptors.update(chunk_descriptors)
+            funnel.merge(chunk_funnel)
+    if verdict_cache is not None:
+        verdict_cache.write(dict(zip(df.loc[todo, smi], flags[todo])), key, list(known), descriptors)
+        verdict_cache.evict()
+    if funnel_path is not None:
+        for flag in flags[~todo]:
+            funnel.count(flag, cached=True)
+        funnel.save(funnel_path, int(gen))
+    return flags
+
+
+def init_filter_worker(gen, config, verdict_cache=None):
+    # build the Filter once when the worker starts
+    global _WORKER_ARGS, _WORKER_CACHE
+    _WORKER_ARGS = (gen, config)
+    _WORKER_CACHE = (verdict_cache, filter_verdict_key(gen, config) if verdict_cache is not None else None)
+    get_filter(gen, config)
+
+
+def passed_descriptors(molsfilter: Filter, smi, flag):
+    # descriptors of a loaded mol passing the filter as a csv field list, None if it failed or was neutralized
+    if flag != "PASS" or molsfilter.input_smiles != smi:
+        return None
+    # computed by pp_filter, which every passing mol has run
+    mol_desc = molsfilter.descriptors()
+    return ",".join(str(mol_desc[k]) for k in DESCRIPTOR_NAMES)
+
+
+def filter_smiles(smiles_list):
+    # flags and descriptors of a chunk of smiles, and the funnel of the chunk
+    molsfilter = get_filter(*_WORKER_ARGS)
+    molsfilter.funnel = FilterFunnel()
+    flags = []
+    descriptors = {}
+    for smi in smiles_list:
+        flags.append(mol_filter(molsfilter, smi))
+        desc = passed_descriptors(molsfilter, smi, flags[-1])
+        if desc is not None:
+            descriptors[smi] = desc
+    return flags, descriptors, molsfilter.funnel
+
+
+def filter_chunk(lines):
+    """
+    return the lines passing all filters with the flag appended, and the descriptors of their mols
+    as id,smiles,descriptors lines. Descriptors of mols changed by neutralization are not returned.
+    With a verdict cache, descriptors of cached mols come from the cache, and the new verdicts with their
+    descriptors and the smiles found in the cache are returned as well. The funnel of the chunk comes last.
+    """
+    molsfilter = get_filter(*_WORKER_ARGS)
+    molsfilter.funnel = FilterFunnel()
+    verdict_cache, key = _WORKER_CACHE
+    lines = [line.strip().split(",") for line in lines]
+    known, descriptors = verdict_cache.get_many(set(line[-5] for line in lines), key, True) if \
+        verdict_cache is not None else ({}, {})
+    todo = [line for line in lines if line[-5] not in known]
+    res = []
+    desc_res = []
+    verdicts = {}
+    new_descriptors = {}
+    for line in todo:
+        molsfilter.load_mol(line[-5])
+        verdicts[line[-5]] = run_filter(molsfilter)
+        desc = passed_descriptors(molsfilter, line[-5], verdicts[line[-5]])
+        if desc is not None:
+            new_descriptors[line[-5]] = desc
+            desc_res.append(",".join([line[-4], line[-5], desc]) + "\n")
+    for line in lines:
+        if line[-5] in known:
+            molsfilter.funnel.count(known[line[-5]], cached=True)
+            if line[-5] in descriptors:
+                desc_res.append(",".join([line[-4], line[-5], descriptors[line[-5]]]) + "\n")
+        if known.get(line[-5], verdicts.get(line[-5])) == "PASS":
+            res.append(",".join(line) + ",PASS\n")
+    return res, desc_res, verdicts, new_descriptors, list(known), molsfilter.funnel
+
+
+def read_chunks(file_path, chunk_size):
+    chunk = []
+    with open(file_path, "r") as inf:
+        for line in inf:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def pool_filter(file_path, out_path, gen, config, cpu_num, chunk_size=500, desc_path=None, verdict_cache=None,
+                funnel_path=None):
+    """
+    filter a mutation csv with long-lived worker processes, chunks are handed out as workers get free
+    and PASS rows are written to out_path in input order.
+    Descriptors of the PASS mols are kept in desc_path if given, so later steps need not compute them again.
+    Workers look up verdict_cache before filtering, new verdicts are written back in the background.
+    Counts per label and time per stage of all workers are written to funnel_path if given.
+    """
+    passed = 0
+    funnel = FilterFunnel()
+    descf = None
+    key = None
+    worker_cache = None
+    if verdict_cache is not None:
+        key = filter_verdict_key(gen, config)
+        # sqlite connections must not cross fork, workers get a copy without connection and writer
+        verdict_cache.disconnect()
+        worker_cache = copy.copy(verdict_cache)
+    try:
+        with multiprocessing.Pool(cpu_num if cpu_num > 0 else None, initializer=init_filter_worker,
+                                  initargs=(gen, config, worker_cache)) as pool:
+            if verdict_cache is not None:
+                verdict_cache.start()
+            with open(out_path, "w") as outf:
+                if desc_path is not None:
+                    descf = open(desc_path, "w")
+                    descf.write(",".join(["id", "smiles"] + DESCRIPTOR_NAMES) + "\n")
+                for res, desc_res, verdicts, new_descriptors, hits, chunk_funnel in pool.imap(
+                        filter_chunk, read_chunks(file_path, chunk_size)):
+                    outf.writelines(res)
+                    passed += len(res)
+                    funnel.merge(chunk_funnel)
+                    if descf is not None:
+                        descf.writelines(desc_res)
+                    if verdict_cache is not None:
+                        verdict_cache.write(verdicts, key, hits, new_descriptors)
+    finally:
+        if descf is not None:
+            descf.close()
+        if verdict_cache is not None:
+            verdict_cache.close()
+            verdict_cache.evict()
+    if funnel_path is not None:
+        funnel.save(funnel_path, int(gen))
+    return passed
+
+
 def file_filter(file_path, workdir, gen, config):
     molsfilter = Filter(gen, config)
     with open(file_path, "r") as inf:
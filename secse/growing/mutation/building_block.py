@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: building_block.py
+@time: 2026/10/18/18:40
+"""
+import bisect
+import hashlib
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from pandarallel import pandarallel
+from rdkit import Chem, DataStructs
+from rdkit.Chem import rdChemReactions
+from rdkit.Chem.rdMolDescriptors import CalcExactMolWt
+
+from growing.mutation.mutation import LRUCache, seed_random, template_screen_fp
+
+BB_INDEX_VERSION = 2
+# version of the partner sampling, bump when partners drawn for a seed and rule change
+PARTNER_SAMPLING_VERSION = 1
+# partner mols parsed per worker
+BB_MOL_CACHE_SIZE = 50000
+
+# building block indexes already loaded in this process, forked workers inherit them from the parent
+_BB_INDEXES = {}
+# reactive group patterns compiled in this process
+_GROUP_PATTERNS = {}
+
+
+def file_md5(path, md5):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+
+
+def load_reaction_rules(rules_path):
+    """
+    two component rules, csv with columns Rule ID, SMARTS and Priority.
+    The first reactant template matches the seed and the second one the building block.
+    """
+    rules_df = pd.read_csv(rules_path, dtype=str)
+    rules_dict = {}
+    for row in rules_df.to_dict("records"):
+        rxn = rdChemReactions.ReactionFromSmarts(row["SMARTS"])
+        # drop unwanted rules where Priority < 0
+        if rxn.GetNumReactantTemplates() != 2 or int(row["Priority"]) <= 0:
+            continue
+        rules_dict[row["Rule ID"]] = (rxn, row["Priority"])
+    return rules_dict
+
+
+def leaving_mass(rxn):
+    """
+    upper estimate of the mass a two component rule removes from seed and building block,
+    None if a removed atom has no fixed element. Reactant atoms unmapped or missing from the products are removed.
+    """
+    pt = Chem.GetPeriodicTable()
+    h_mass = pt.GetMostCommonIsotopeMass(1)
+    kept = set(a.GetAtomMapNum() for template in rxn.GetProducts() for a in template.GetAtoms())
+    kept.discard(0)
+    mass = 0.0
+    for template in rxn.GetReactants():
+        for atom in template.GetAtoms():
+            mass += 4 * h_mass
+            if atom.GetAtomMapNum() not in kept:
+                if atom.GetAtomicNum() == 0:
+                    return None
+                mass += pt.GetMostCommonIsotopeMass(atom.GetAtomicNum())
+    return mass
+
+
+def group_pattern(smarts):
+    if smarts not in _GROUP_PATTERNS:
+        pattern = Chem.MolFromSmarts(smarts)
+        _GROUP_PATTERNS[smarts] = (pattern, template_screen_fp(pattern))
+    return _GROUP_PATTERNS[smarts]
+
+
+def bb_groups(smi, groups):
+    # molecular weight of a building block and the reactive groups it carries
+    mol = Chem.MolFromSmiles(smi)
+    if mol is None:
+        return None
+    fp = Chem.PatternFingerprint(mol)
+    matched = []
+    for k, smarts in enumerate(groups):
+        pattern, screen = group_pattern(smarts)
+        if DataStructs.AllProbeBitsMatch(screen, fp) and mol.HasSubstructMatch(pattern):
+            matched.append(k)
+    return CalcExactMolWt(mol), matched
+
+
+class BuildingBlocks(object):
+    """
+    building block library indexed by the reactive groups of two component rules, members of each group are
+    sorted by molecular weight so that the partners fitting a seed are a prefix of the group
+    """
+
+    def __init__(self, library, rules_path, cache_dir, max_partners=20, cpu_num=1):
+        self.library = library
+        self.rules_path = rules_path
+        self.cache_dir = cache_dir
+        self.max_partners = max_partners
+        md5 = hashlib.md5()
+        file_md5(self.library, md5)
+        file_md5(self.rules_path, md5)
+        md5.update(str(BB_INDEX_VERSION).encode())
+        self.key = md5.hexdigest()
+        # partners of a seed only depend on the index, the number of partners and the sampling
+        self.version = "{}:partners={}:sampling={}".format(self.key, self.max_partners, PARTNER_SAMPLING_VERSION)
+        self.index = None
+        self.mol_cache = LRUCache(BB_MOL_CACHE_SIZE)
+        self.load(cpu_num)
+
+    def __getstate__(self):
+        # do not pickle the index into pandarallel workers
+        state = self.__dict__.copy()
+        state["index"] = None
+        state["mol_cache"] = LRUCache(BB_MOL_CACHE_SIZE)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+    def load(self, cpu_num=1):
+        self.index = _BB_INDEXES.get(self.key)
+        if self.index is not None:
+            return
+        index_path = os.path.join(self.cache_dir, "building_blocks_{}.pkl".format(self.key))
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, "rb") as f:
+                    self.index = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self.index = None
+        if self.index is None:
+            self.index = self.build(cpu_num)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = index_path + ".{}.tmp".format(os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self.index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, index_path)
+        _BB_INDEXES[self.key] = self.index
+
+    def build(self, cpu_num=1):
+        print("Indexing building blocks: {}".format(self.library))
+        rules = load_reaction_rules(self.rules_path)
+        groups = sorted(set(Chem.MolToSmarts(v[0].GetReactantTemplate(1)) for v in rules.values()))
+        bb_df = pd.read_csv(self.library, sep=r"\s+", header=None, usecols=[0, 1], names=["smiles", "id"],
+                            dtype=str)
+        # ids end up in csv files
+        bb_df["id"] = bb_df["id"].fillna(pd.Series(["BB_" + str(i) for i in bb_df.index], index=bb_df.index))
+        bb_df["id"] = bb_df["id"].str.replace(",", "_")
+        if bb_df.shape[0] > 1 and cpu_num > 1:
+            pandarallel.initialize(verbose=0, nb_workers=cpu_num)
+            res = bb_df["smiles"].parallel_apply(lambda x: bb_groups(x, groups))
+        else:
+            res = bb_df["smiles"].apply(lambda x: bb_groups(x, groups))
+        bb_df["res"] = res
+        bb_df = bb_df.dropna(subset=["res"]).reset_index(drop=True)
+        mw = np.array([i[0] for i in bb_df["res"]])
+        members = {k: [] for k in range(len(groups))}
+        for n, i in enumerate(bb_df["res"]):
+            for k in i[1]:
+                members[k].append(n)
+        members = {groups[k]: np.array(v, dtype=np.int64)[np.argsort(mw[v], kind="stable")] if v else
+                   np.array([], dtype=np.int64) for k, v in members.items()}
+        rule_groups = {k: Chem.MolToSmarts(v[0].GetReactantTemplate(1)) for k, v in rules.items()}
+        print("{} building blocks, {} reactive groups.".format(bb_df.shape[0], len(groups)))
+        return {"key": self.key, "rules": rules, "rule_groups": rule_groups,
+                "screen": {k: template_screen_fp(v[0].GetReactantTemplate(0)) for k, v in rules.items()},
+                "leaving": {k: leaving_mass(v[0]) for k, v in rules.items()},
+                "smiles": bb_df["smiles"].tolist(), "ids": bb_df["id"].tolist(), "mw": mw,
+                "members": members, "members_mw": {k: mw[v] for k, v in members.items()}}
+
+    @property
+    def rules(self):
+        return self.index["rules"]
+
+    def partner_mol(self, n):
+        if n in self.mol_cache:
+            return self.mol_cache.get(n)
+        mol = Chem.MolFromSmiles(self.index["smiles"][n])
+        self.mol_cache.put(n, mol)
+        return mol
+
+    def partners(self, item, max_mw=None, seed=""):
+        """
+        at most max_partners building blocks with the reactive group of the rule, lighter than max_mw.
+        The sample is drawn with a generator seeded from seed smiles and rule, the same for every run.
+        """
+        group = self.index["rule_groups"][item]
+        members = self.index["members"][group]
+        size = len(members)
+        leaving = self.index["leaving"][item]
+        if max_mw is not None and leaving is not None:
+            size = bisect.bisect_right(self.index["members_mw"][group], max_mw + leaving)
+        if size <= self.max_partners:
+            picked = range(size)
+        else:
+            picked = seed_random(seed, item).sample(range(size), self.max_partners)
+        return [(self.index["ids"][members[i]], self.partner_mol(members[i])) for i in picked]
@@ -4,69 +4,335 @@ import sys
 sys.path.append(os.getenv("SECSE"))
 import subprocess
 import copy
+import configparser
+import time
+from collections import OrderedDict
+import hashlib
+import json
+import math
+import pickle
+import random
+import shutil
 import sqlite3
 import pandas as pd
 import rdkit
 from pandarallel import pandarallel
-from rdkit import Chem
+from rdkit import Chem, DataStructs
 from rdkit.Chem import rdChemReactions
+from rdkit.Chem.rdMolDescriptors import CalcExactMolWt
 
 from uitilities.wash_mol import get_bridged_atoms, neutralize_atoms
+from growing.filter import FilterFunnel, get_filter, mol_filter
 
 rdkit.RDLogger.DisableLog("rdApp.*")
 
 
 RULE_DB = os.path.join(os.getenv("SECSE"), "growing/mutation/rules_demo.db")
+# compiled rule bundles, keyed by the hash of the rule database and the table list
+RULE_BUNDLE_DIR = os.path.join(os.getenv("SECSE"), "growing/mutation/compiled")
+RULE_BUNDLE_VERSION = 4
+COMMON_TABLES = ['B-001',
+                 'G-001', 'G-003', 'G-004', 'G-005', 'G-006', 'G-007',
+                 'M-001', 'M-002', 'M-003', 'M-004', 'M-005', 'M-006', 'M-007', 'M-008', 'M-009', 'M-010'
+                 ]
+SPACER_TABLE = "G-002"
+# canonical product smiles kept per worker, keyed by the raw product smiles
+CANON_CACHE_SIZE = 200000
+
+# rule bundles already loaded in this process, forked workers inherit them from the parent
+_RULE_BUNDLES = {}
+
+
+def template_screen_fp(template):
+    # pattern fingerprint of a reactant template, a seed can only match the template if it has all these bits
+    template = Chem.Mol(template)
+    template.UpdatePropertyCache(strict=False)
+    Chem.FastFindRings(template)
+    return Chem.PatternFingerprint(template)
+
+
+def seed_random(*parts):
+    # random generator seeded from the seed smiles, reproducible and independent of the worker process
+    return random.Random(hashlib.md5("\t".join(parts).encode()).hexdigest())
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        value = self.data[key]
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+def seed_automorphisms(mol, max_num=1000):
+    """
+    atom permutations of the seed keeping its graph and atom invariants,
+    products of two matches related by such a permutation are the same molecule
+    """
+    identity = tuple(range(mol.GetNumAtoms()))
+    # keep it simple for seeds with stereo
+    if any(a.GetChiralTag() != Chem.ChiralType.CHI_UNSPECIFIED for a in mol.GetAtoms()) or any(
+            b.GetStereo() != Chem.BondStereo.STEREONONE for b in mol.GetBonds()):
+        return [identity]
+    ranks = list(Chem.CanonicalRankAtoms(mol, breakTies=False))
+    matches = mol.GetSubstructMatches(mol, uniquify=False, maxMatches=max_num)
+    if len(matches) >= max_num:
+        return [identity]
+    res = [m for m in matches if all(ranks[i] == ranks[j] for i, j in enumerate(m))]
+    return res if res else [identity]
+
+
+def seed_fragments(mol, mol_fp):
+    """
+    pattern fingerprint and exact mass of each fragment of the seed,
+    products keep only the fragment matched by the rule, e.g. counterions of salts are dropped
+    """
+    frags = Chem.GetMolFrags(mol, asMols=True)
+    if len(frags) == 1:
+        return [(mol_fp, CalcExactMolWt(mol))]
+    return [(Chem.PatternFingerprint(i), CalcExactMolWt(i)) for i in frags]
+
+
+def load_common_rules(conn, tables):
+    rules_dict = {}
+    for table in tables:
+        sql = 'select * from "{0}"'.format(table)
+        for row in conn.execute(sql).fetchall():
+            row = dict(row)
+            rules_dict[row["Rule ID"]] = (rdChemReactions.ReactionFromSmarts(row["SMARTS"]), row['Priority'])
+    return rules_dict
+
+
+def load_spacer_rings_rules(conn):
+    rules_dict = {}
+    sql = 'select * from "{}"'.format(SPACER_TABLE)
+    for row in conn.execute(sql).fetchall():
+        row = dict(row)
+        pri = int(row['Spacer Priority']) * int(row['Ring Priority'])
+        rules_dict[row["Rule ID"]] = (rdChemReactions.ReactionFromSmarts(row["SMARTS"]), str(pri))
+    return rules_dict
+
+
+def rule_property_delta(rxn):
+    """
+    lower bound of the exact mass increment of a single reactant rule,
+    None if the rule deletes matched atoms, unmapped or mapped but missing from the product,
+    since the mass dropped with them is unknown
+    """
+    if rxn.GetNumReactantTemplates() != 1:
+        return None
+    pt = Chem.GetPeriodicTable()
+    h_mass = pt.GetMostCommonIsotopeMass(1)
+    react = rxn.GetReactantTemplate(0)
+    prod = rxn.GetProductTemplate(0)
+    react_atoms = {a.GetAtomMapNum(): a for a in react.GetAtoms()}
+    if 0 in react_atoms:
+        return None
+    if set(react_atoms) - set(a.GetAtomMapNum() for a in prod.GetAtoms()):
+        return None
+
+    def valence(mol, atom, ref=None):
+        total = 0
+        for bond in atom.GetBonds():
+            order = bond.GetBondTypeAsDouble()
+            if ref is not None and bond.HasQuery() and bond.GetSmarts() in ("", "~"):
+                # bonds kept from the seed are copied with their own order
+                other = bond.GetOtherAtom(atom).GetAtomMapNum()
+                ref_bond = ref[0].GetBondBetweenAtoms(ref[1][atom.GetAtomMapNum()].GetIdx(),
+                                                      ref[1][other].GetIdx()) if other in ref[1] else None
+                if ref_bond is not None:
+                    order = ref_bond.GetBondTypeAsDouble()
+            total += order
+        return total
+
+    mw = 0.0
+    for atom in prod.GetAtoms():
+        num = atom.GetAtomicNum()
+        if atom.GetFormalCharge() != 0:
+            # the filter neutralizes charged products
+            mw -= h_mass
+        if atom.GetAtomMapNum() == 0:
+            # new atoms, their hydrogens only add mass
+            mw += pt.GetMostCommonIsotopeMass(num) if num > 0 else 0
+            continue
+        ref = react_atoms.get(atom.GetAtomMapNum())
+        if ref is None:
+            return None
+        lost_h = max(0, math.ceil(valence(prod, atom, (react, react_atoms)) - valence(react, ref)))
+        if num > 0 and num != ref.GetAtomicNum():
+            if ref.GetAtomicNum() == 0:
+                return None
+            mw += pt.GetMostCommonIsotopeMass(num) - pt.GetMostCommonIsotopeMass(ref.GetAtomicNum())
+            lost_h += 4
+        mw -= lost_h * h_mass
+    return mw
+
+
+def rule_bundle_key(tables):
+    md5 = hashlib.md5()
+    with open(RULE_DB, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    md5.update(",".join(tables).encode())
+    md5.update(str(RULE_BUNDLE_VERSION).encode())
+    return md5.hexdigest()
+
+
+def compile_rule_bundle(key, tables):
+    conn = sqlite3.connect(RULE_DB)
+    conn.row_factory = sqlite3.Row
+    rules_dict = load_common_rules(conn, [i for i in tables if i != SPACER_TABLE])
+    if SPACER_TABLE in tables:
+        rules_dict.update(load_spacer_rings_rules(conn))
+    conn.close()
+    # drop unwanted rules where Priority < 0
+    rules_dict = {k: v for k, v in rules_dict.items() if int(v[1]) > 0}
+    # prebuilt applicability index: pattern fingerprint for the reactant template of each rule
+    rules_screen = {k: template_screen_fp(v[0].GetReactantTemplate(0)) for k, v in rules_dict.items()}
+    # lower bounds of the mass increment, to skip rules whose products must fail the MW filter
+    rules_delta = {k: rule_property_delta(v[0]) for k, v in rules_dict.items()}
+    return {"key": key, "tables": tables, "rules": rules_dict, "screen": rules_screen, "delta": rules_delta}
+
+
+def load_rule_bundle(tables=None):
+    """
+    load compiled rules, compile from the rule database only if no bundle was built for it before
+    """
+    if tables is None:
+        tables = COMMON_TABLES + [SPACER_TABLE]
+    tables = list(tables)
+    stat = os.stat(RULE_DB)
+    cache_key = (",".join(tables), stat.st_mtime, stat.st_size)
+    if cache_key in _RULE_BUNDLES:
+        return _RULE_BUNDLES[cache_key]
+
+    key = rule_bundle_key(tables)
+    bundle_path = os.path.join(RULE_BUNDLE_DIR, "rules_{}.pkl".format(key))
+    bundle = None
+    if os.path.exists(bundle_path):
+        try:
+            with open(bundle_path, "rb") as f:
+                bundle = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            bundle = None
+    if bundle is None:
+        bundle = compile_rule_bundle(key, tables)
+        try:
+            os.makedirs(RULE_BUNDLE_DIR, exist_ok=True)
+            # write to a temporary file first, so that concurrent runs never read a partial bundle
+            tmp_path = bundle_path + ".{}.tmp".format(os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, bundle_path)
+        except OSError as e:
+            print("Can not write compiled rules: {}".format(e))
+    _RULE_BUNDLES[cache_key] = bundle
+    _RULE_BUNDLES[key] = bundle
+    return bundle
+
+
+def get_spacer_ratio(gen):
+    # control ratio of ring with spacer based on different stage
+    if gen <= 3:
+        return 0.3
+    elif gen <= 7:
+        return 0.1
+    else:
+        return 0.01
 
 
 class Mutation:
 
-    def __init__(self, num, workdir):
+    def __init__(self, num, workdir, seen=None, seed_cache=None, profile=False, budget=None, gen=1,
+                 config_path=None, rule_weights=None, spacer_ratio=None, building_blocks=None):
         # self.load_reaction()
         self.workdir = workdir
-        # self.load_buildingblock(num=num)
+        # lazy mode: number of products passing the filter wanted per seed
+        self.budget = budget
+        # lazy mode: weights of rule families on top of priority and ratio of G-002 in the budget
+        self.rule_weights = rule_weights if rule_weights is not None else {}
+        self.spacer_ratio = spacer_ratio if spacer_ratio is not None else get_spacer_ratio(gen)
+        self.gen = gen
+        self.config_path = config_path
+        # upper limit of molecular weight from the property filter
+        self.mw_limit = None
+        if config_path is not None:
+            config = configparser.ConfigParser()
+            config.read(config_path)
+            self.mw_limit = config.getfloat("properties", "MW", fallback=None)
+        # collect time and yield per rule
+        self.profile = profile
+        self.rule_stats = {}
+        # molecules generated in former generations
+        self.seen = seen
+        # products of seeds mutated before
+        self.seed_cache = seed_cache
+        # building block library for two component rules
+        self.building_blocks = building_blocks
         self.rules_dict = {}
-        self.load_common_rules()
-        self.load_spacer_rings_rules()
-
-        # drop unwanted rules where Priority < 0
-        self.rules_dict = {k: v for k, v in self.rules_dict.items() if int(v[1]) > 0}
+        self.rules_screen = {}
+        self.rules_delta = {}
+        self.rules_key = None
+        self.rules_tables = None
+        self.rules_version = None
+        self.load_rules()
         self.out_product_smiles = []
         self.input_smiles = None
         self.mol = None
+        self.screen_skipped = 0
+        self.seen_skipped = 0
+        self.filter_failed = 0
+        self.property_skipped = 0
+        self.cache_hit = False
+        self.automorphisms = None
+        self.seed_frags = None
+        self.funnel = None
+        self.canon_cache = LRUCache(CANON_CACHE_SIZE)
+        self.canon_stats = {"products": 0, "duplicates": 0, "cache_hits": 0, "sanitize_failures": 0}
 
-    def load_common_rules(self, tables=None):
-        if tables is None:
-            tables = ['B-001',
-                      'G-001', 'G-003', 'G-004', 'G-005', 'G-006', 'G-007',
-                      'M-001', 'M-002', 'M-003', 'M-004', 'M-005', 'M-006', 'M-007', 'M-008', 'M-009', 'M-010'
-                      ]
-        rules_dict = {}
-        for table in tables:
-            sql = 'select * from "{0}"'.format(table)
-            conn = sqlite3.connect(RULE_DB)
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            c.execute(sql)
-            rs = c.fetchall()
-            for row in rs:
-                row = dict(row)
-                rules_dict[row["Rule ID"]] = (rdChemReactions.ReactionFromSmarts(row["SMARTS"]), row['Priority'])
-        self.rules_dict.update(rules_dict)
-
-    def load_spacer_rings_rules(self):
-        rules_dict = {}
-        sql = 'select * from "{}"'.format("G-002")
-        conn = sqlite3.connect(RULE_DB)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute(sql)
-        rs = c.fetchall()
-        for row in rs:
-            row = dict(row)
-            pri = int(row['Spacer Priority']) * int(row['Ring Priority'])
-            rules_dict[row["Rule ID"]] = (rdChemReactions.ReactionFromSmarts(row["SMARTS"]), str(pri))
-        self.rules_dict.update(rules_dict)
+    def __getstate__(self):
+        # do not pickle compiled rules into pandarallel workers, they are loaded once per worker process
+        state = self.__dict__.copy()
+        state["rules_dict"] = None
+        state["rules_screen"] = None
+        state["rules_delta"] = None
+        state["canon_cache"] = LRUCache(CANON_CACHE_SIZE)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        bundle = _RULE_BUNDLES.get(self.rules_key)
+        if bundle is None:
+            bundle = load_rule_bundle(self.rules_tables)
+        self.rules_dict = bundle["rules"]
+        self.rules_screen = bundle["screen"]
+        self.rules_delta = bundle["delta"]
+
+    def load_rules(self, tables=None):
+        bundle = load_rule_bundle(tables)
+        self.rules_key = bundle["key"]
+        self.rules_tables = bundle["tables"]
+        # products of a seed only depend on the rules and the property limit used to skip rules
+        self.rules_version = self.rules_key
+        if self.mw_limit is not None:
+            self.rules_version += ":MW={}".format(self.mw_limit)
+        if self.building_blocks is not None:
+            self.rules_version += ":BB={}".format(self.building_blocks.version)
+        self.rules_dict = bundle["rules"]
+        self.rules_screen = bundle["screen"]
+        self.rules_delta = bundle["delta"]
 
     # set smiles
     def load_mol(self, input_smiles):
@@ -79,33 +345,244 @@ class Mutation:
             self.mol = neutralize_atoms(self.mol)
             # self.input_smiles = Chem.MolToSmiles(self.mol)
 
+    def product_key(self, product, react):
+        # products are identified by the reactant atoms kept by mapping number and the reactant atoms deleted,
+        # taken up to the symmetry of the seed
+        mapped = []
+        present = set()
+        for atom in product.GetAtoms():
+            if atom.HasProp("react_atom_idx"):
+                idx = (atom.GetIntProp("react_idx"), atom.GetIntProp("react_atom_idx"))
+                present.add(idx)
+                if atom.HasProp("old_mapno"):
+                    mapped.append((atom.GetIntProp("old_mapno"), idx))
+        mapped = [i[1] for i in sorted(mapped)]
+        deleted = [(r, i) for r in range(len(react)) for i in range(react[r].GetNumAtoms()) if (r, i) not in present]
+
+        def permute(sigma, idx):
+            return (idx[0], sigma[idx[1]]) if idx[0] == 0 else idx
+
+        return min((tuple(permute(sigma, i) for i in mapped), tuple(sorted(permute(sigma, i) for i in deleted)))
+                   for sigma in self.automorphisms)
+
+    def canonical_product(self, product, item):
+        self.canon_stats["products"] += 1
+        # the raw product smiles only depends on the product, not on the seed or rule it came from
+        try:
+            key = Chem.MolToSmiles(product, canonical=False)
+        except Exception:
+            key = None
+        if key is not None and key in self.canon_cache:
+            self.canon_stats["cache_hits"] += 1
+            if self.profile:
+                self.rule_profile(item)["cache_hits"] += 1
+            smi = self.canon_cache.get(key)
+        else:
+            try:
+                Chem.SanitizeMol(product)
+                # enumerator = rdMolStandardize.TautomerEnumerator()
+                # canon = enumerator.Canonicalize(mol_tuple[0])
+                # smi = Chem.MolToSmiles(Chem.RemoveHs(canon), isomericSmiles=True, kekuleSmiles=False)
+                smi = Chem.MolToSmiles(Chem.RemoveHs(product), isomericSmiles=True, kekuleSmiles=False)
+            except Exception:
+                smi = None
+            if key is not None:
+                self.canon_cache.put(key, smi)
+        if smi is None:
+            self.canon_stats["sanitize_failures"] += 1
+            raise ValueError("Can not sanitize product")
+        return smi
+
+    def rule_profile(self, item):
+        if item not in self.rule_stats:
+            self.rule_stats[item] = {"match_time": 0.0, "reaction_time": 0.0, "matched": 0, "products": 0,
+                                     "cache_hits": 0, "sanitize_failures": 0}
+            if self.budget is not None:
+                # lazy mode filters products during mutation
+                self.rule_stats[item].update({"filter_in": 0, "filter_pass": 0})
+        return self.rule_stats[item]
+
     def reaction(self, rxn, react, item, partner, priority):
+        failures = self.canon_stats["sanitize_failures"]
+        time1 = time.perf_counter()
         try:
             products = rxn.RunReactants(react)
+            if self.profile:
+                self.rule_profile(item)["reaction_time"] += time.perf_counter() - time1
             uniq = set()
+            keys = set()
             for mol_tuple in products:
-                Chem.SanitizeMol(mol_tuple[0])
-                # enumerator = rdMolStandardize.TautomerEnumerator()
-                # canon = enumerator.Canonicalize(mol_tuple[0])
-                # smi = Chem.MolToSmiles(Chem.RemoveHs(canon), isomericSmiles=True, kekuleSmiles=False)
-                smi = Chem.MolToSmiles(Chem.RemoveHs(mol_tuple[0]), isomericSmiles=True, kekuleSmiles=False)
-                uniq.add(smi)
+                key = self.product_key(mol_tuple[0], react)
+                # same product from a symmetric site
+                if key in keys:
+                    self.canon_stats["duplicates"] += 1
+                    continue
+                keys.add(key)
+                uniq.add(self.canonical_product(mol_tuple[0], item))
             for smi in uniq:
                 self.out_product_smiles.append((smi, item, partner, priority))
+            if self.profile:
+                self.rule_profile(item)["products"] += len(uniq)
         except Exception as e:
             # print(e)
-            pass
+            if self.profile:
+                self.rule_profile(item)["sanitize_failures"] += self.canon_stats["sanitize_failures"] - failures
 
     # add 2021.1.7
     # modify 2021.01.14
     def single_point_mutate(self):
+        if self.budget is not None:
+            # products of lazy enumeration depend on the budget, they are not cached
+            return self.lazy_mutate()
+        if self.seed_cache is not None:
+            seed = Chem.MolToSmiles(self.mol)
+            products = self.seed_cache.get(seed, self.rules_version)
+            if products is not None:
+                self.cache_hit = True
+                self.out_product_smiles = products
+            else:
+                self.rules_mutate()
+                self.seed_cache.put(seed, self.rules_version, self.out_product_smiles)
+        else:
+            self.rules_mutate()
+        self.drop_seen()
+        return self.out_product_smiles
+
+    def drop_seen(self):
+        # drop molecules generated in former generations
+        if self.seen is None:
+            return
+        products = []
+        for i in self.out_product_smiles:
+            if i[0] in self.seen:
+                self.seen_skipped += 1
+            else:
+                products.append(i)
+        self.out_product_smiles = products
+
+    def apply_rule(self, item, mol, mol_fp):
+        rxn = self.rules_dict[item][0]
+        priority = self.rules_dict[item][1]
+        time1 = time.perf_counter()
+        # products of the rule are always heavier than the property filter allows
+        delta = self.rules_delta[item]
+        if self.mw_limit is not None and delta is not None:
+            seed_mw = self.fragment_mw(self.rules_screen[item])
+            if seed_mw is not None and seed_mw + delta - 1e-6 > self.mw_limit:
+                self.property_skipped += 1
+                return
+        # skip rules which can not match the seed before the full substructure match
+        if not DataStructs.AllProbeBitsMatch(self.rules_screen[item], mol_fp):
+            self.screen_skipped += 1
+            if self.profile:
+                self.rule_profile(item)["match_time"] += time.perf_counter() - time1
+            return
+        matched = mol.HasSubstructMatch(rxn.GetReactantTemplate(0))
+        if self.profile:
+            stats = self.rule_profile(item)
+            stats["match_time"] += time.perf_counter() - time1
+            stats["matched"] += int(matched)
+        if matched:
+            self.reaction(rxn, (mol,), item, "", priority)
+
+    def apply_partner_rule(self, item, mol, mol_fp):
+        # two component rule, partners with the reactive group of the rule are taken from the building block index
+        rxn = self.building_blocks.rules[item][0]
+        priority = self.building_blocks.rules[item][1]
+        time1 = time.perf_counter()
+        if not DataStructs.AllProbeBitsMatch(self.building_blocks.index["screen"][item], mol_fp):
+            self.screen_skipped += 1
+            if self.profile:
+                self.rule_profile(item)["match_time"] += time.perf_counter() - time1
+            return
+        matched = mol.HasSubstructMatch(rxn.GetReactantTemplate(0))
+        if self.profile:
+            stats = self.rule_profile(item)
+            stats["match_time"] += time.perf_counter() - time1
+            stats["matched"] += int(matched)
+        if matched:
+            seed_mw = self.fragment_mw(self.building_blocks.index["screen"][item])
+            max_mw = self.mw_limit - seed_mw if self.mw_limit is not None and seed_mw is not None else None
+            for partner_id, partner in self.building_blocks.partners(item, max_mw, self.input_smiles):
+                self.reaction(rxn, (mol, partner), item, partner_id, priority)
+
+    def fragment_mw(self, screen):
+        # mass of the lightest seed fragment the rule can match, None if it can match none
+        mws = [mw for fp, mw in self.seed_frags if DataStructs.AllProbeBitsMatch(screen, fp)]
+        return min(mws) if mws else None
+
+    def partner_rules(self):
+        return self.building_blocks.rules if self.building_blocks is not None else {}
+
+    def rules_mutate(self):
         mol = self.spiro_atom_label()
+        mol_fp = Chem.PatternFingerprint(mol)
+        self.automorphisms = seed_automorphisms(mol)
+        self.seed_frags = seed_fragments(mol, mol_fp)
         for item in self.rules_dict:
-            rxn = self.rules_dict[item][0]
-            priority = self.rules_dict[item][1]
-            if mol.HasSubstructMatch(rxn.GetReactantTemplate(0)):
-                self.reaction(rxn, (mol,), item, "", priority)
+            self.apply_rule(item, mol, mol_fp)
+        for item in self.partner_rules():
+            self.apply_partner_rule(item, mol, mol_fp)
+        self.protected_atom_label_remove()
+        return self.out_product_smiles
+
+    def rule_order(self):
+        # weighted random order without replacement, rules with higher priority tend to come first
+        keys = {}
+        rng = seed_random(self.input_smiles)
+        for rules in [self.rules_dict, self.partner_rules()]:
+            for item in rules:
+                weight = float(rules[item][1]) * self.rule_weights.get("-".join(item.split("-")[:2]), 1)
+                keys[item] = rng.random() ** (1 / weight)
+        return sorted(keys, key=lambda x: keys[x], reverse=True)
+
+    def lazy_mutate(self):
+        """
+        apply rules in priority weighted order and filter products on demand, stop once the budget is met
+        """
+        mol = self.spiro_atom_label()
+        mol_fp = Chem.PatternFingerprint(mol)
+        self.automorphisms = seed_automorphisms(mol)
+        self.seed_frags = seed_fragments(mol, mol_fp)
+        molfilter = get_filter(self.gen, self.config_path)
+        molfilter.funnel = self.funnel = FilterFunnel()
+        spacer_budget = int(round(self.budget * self.spacer_ratio))
+        budget = {True: spacer_budget, False: self.budget - spacer_budget}
+        kept = {True: 0, False: 0}
+        products = []
+        smiles = set()
+        for item in self.rule_order():
+            spacer = item.startswith(SPACER_TABLE)
+            if kept[spacer] >= budget[spacer]:
+                if kept[not spacer] >= budget[not spacer]:
+                    break
+                continue
+            start = len(self.out_product_smiles)
+            if item in self.rules_dict:
+                self.apply_rule(item, mol, mol_fp)
+            else:
+                self.apply_partner_rule(item, mol, mol_fp)
+            for product in self.out_product_smiles[start:]:
+                if kept[spacer] >= budget[spacer]:
+                    break
+                if product[0] in smiles:
+                    continue
+                if self.seen is not None and product[0] in self.seen:
+                    self.seen_skipped += 1
+                    continue
+                smiles.add(product[0])
+                passed = mol_filter(molfilter, product[0]) == "PASS"
+                if passed:
+                    products.append(product)
+                    kept[spacer] += 1
+                else:
+                    self.filter_failed += 1
+                if self.profile:
+                    stats = self.rule_profile(item)
+                    stats["filter_in"] += 1
+                    stats["filter_pass"] += int(passed)
         self.protected_atom_label_remove()
+        self.out_product_smiles = products
         return self.out_product_smiles
 
     def spiro_atom_label(self):
@@ -159,21 +636,149 @@ class Mutation:
     def clean(self):
         self.input_smiles = None
         self.out_product_smiles = []
+        self.screen_skipped = 0
+        self.seen_skipped = 0
+        self.filter_failed = 0
+        self.property_skipped = 0
+        self.cache_hit = False
+        self.funnel = None
+        self.canon_stats = {"products": 0, "duplicates": 0, "cache_hits": 0, "sanitize_failures": 0}
+        self.rule_stats = {}
 
+    def seed_stats(self):
+        stats = {"seed": self.input_smiles, "screen_skipped": self.screen_skipped,
+                 "property_skipped": self.property_skipped, "seen_skipped": self.seen_skipped,
+                 "seed_cache_hit": self.cache_hit, "canonicalization": dict(self.canon_stats)}
+        if self.budget is not None:
+            stats["filter_failed"] = self.filter_failed
+            stats["funnel"] = self.funnel
+        if self.profile:
+            stats["rules"] = self.rule_stats
+        return stats
 
-def mutation_df(df: pd.DataFrame, workdir, cpu_num, gen=1):
-    workdir = os.path.join(workdir, "generation_" + str(gen))
-    mutation = Mutation(5000, workdir)
 
-    def mutation_per_row(mut: Mutation, smi):
-        # mutation for each seed molecule
-        try:
-            mut.load_mol(smi)
-        except AssertionError:
-            return None
-        mut.single_point_mutate()
-        return mut.out_product_smiles
+def write_rule_profile(workdir, rule_stats):
+    """
+    time and yield per rule of one generation, summed over seeds
+    """
+    profile = {}
+    for seed_rules in rule_stats:
+        for item, stats in seed_rules.items():
+            if item not in profile:
+                profile[item] = dict.fromkeys(stats, 0)
+            for k, v in stats.items():
+                profile[item][k] += v
+    for stats in profile.values():
+        stats["match_time"] = round(stats["match_time"], 6)
+        stats["reaction_time"] = round(stats["reaction_time"], 6)
+        if "filter_in" in stats:
+            stats["pass_rate"] = round(stats["filter_pass"] / stats["filter_in"], 4) if stats["filter_in"] else None
+    with open(os.path.join(workdir, "rule_profile.json"), "w") as f:
+        json.dump(profile, f, indent=2)
+
+
+def count_rules(path, col=-3):
+    # number of mutation rows per rule in a mutation/generation csv
+    counts = {}
+    with open(path, "r") as f:
+        for line in f:
+            item = line.rstrip("\n").split(",")[col]
+            counts[item] = counts.get(item, 0) + 1
+    return counts
 
+
+def add_filter_yield(workdir, filter_in, filter_pass):
+    """
+    add number of molecules sent to filter and passed filter per rule to the rule profile
+    """
+    path = os.path.join(workdir, "rule_profile.json")
+    with open(path, "r") as f:
+        profile = json.load(f)
+    for item, stats in profile.items():
+        stats["filter_in"] = int(filter_in.get(item, 0))
+        stats["filter_pass"] = int(filter_pass.get(item, 0))
+        stats["pass_rate"] = round(stats["filter_pass"] / stats["filter_in"], 4) if stats["filter_in"] else None
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+
+def write_mutation_report(workdir, mutation: Mutation, seed_stats):
+    skipped = sum([i["screen_skipped"] for i in seed_stats])
+    tested = (len(mutation.rules_dict) + len(mutation.partner_rules())) * len(seed_stats)
+    print("Rule screen skipped {} of {} rule tests.".format(skipped, tested))
+    property_skipped = sum([i["property_skipped"] for i in seed_stats])
+    if mutation.mw_limit is not None:
+        print("{} rule tests skipped by molecular weight limit.".format(property_skipped))
+    seen_skipped = sum([i["seen_skipped"] for i in seed_stats])
+    if mutation.seen is not None:
+        print("{} products generated in former generations dropped.".format(seen_skipped))
+    seed_cache_hits = sum([i["seed_cache_hit"] for i in seed_stats])
+    if mutation.seed_cache is not None:
+        print("{} of {} seeds found in seed cache.".format(seed_cache_hits, len(seed_stats)))
+        mutation.seed_cache.evict()
+    if mutation.budget is not None:
+        print("Lazy mutation kept at most {} products per seed, {} products failed the filter.".format(
+            mutation.budget, sum([i["filter_failed"] for i in seed_stats])))
+        # products filtered during mutation, the kept parent mols are not counted
+        funnel = FilterFunnel()
+        for i in seed_stats:
+            seed_funnel = i.pop("funnel")
+            if seed_funnel is not None:
+                funnel.merge(seed_funnel)
+        funnel.save(os.path.join(workdir, "filter_funnel.json"), int(mutation.gen))
+    canon_stats = {"products": 0, "duplicates": 0, "cache_hits": 0, "sanitize_failures": 0}
+    for i in seed_stats:
+        for k in canon_stats:
+            canon_stats[k] += i["canonicalization"][k]
+    reused = canon_stats["duplicates"]
+    canon_stats["duplicate_rate"] = round(reused / (canon_stats["products"] + reused), 4) if reused else 0
+    canon_stats["hit_rate"] = round(canon_stats["cache_hits"] / canon_stats["products"], 4) if \
+        canon_stats["cache_hits"] else 0
+    print("Share of symmetric duplicate products skipped before canonicalization: {}, canonicalization cache hit "
+          "rate: {}, sanitization failures: {}".format(canon_stats["duplicate_rate"], canon_stats["hit_rate"],
+                                                       canon_stats["sanitize_failures"]))
+    if mutation.profile:
+        write_rule_profile(workdir, [i.pop("rules") for i in seed_stats])
+    report = {"rules": len(mutation.rules_dict) + len(mutation.partner_rules()),
+              "seeds": len(seed_stats),
+              "screen_skipped": skipped,
+              "property_skipped": property_skipped,
+              "seen_skipped": seen_skipped,
+              "seed_cache_hits": seed_cache_hits,
+              "canonicalization": canon_stats,
+              "per_seed": seed_stats}
+    with open(os.path.join(workdir, "mutation_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def write_seed_lines(f, last_gen_info, products, new_id):
+    # keep parent mol
+    f.write(",".join(last_gen_info + [last_gen_info[0], last_gen_info[1].split("-dp")[0].split("-C")[0],
+                                      "Na-Na-Na", "", "3"]) + "\n")
+    # write mutation mols
+    for k, info in enumerate(products):
+        info = list(map(str, info))
+        new_line = last_gen_info + [info[0]] + [new_id(k)] + info[1:]
+        f.write(",".join(new_line) + "\n")
+
+
+def mutation_per_row(mut: Mutation, smi):
+    # mutation for each seed molecule
+    try:
+        mut.load_mol(smi)
+    except AssertionError:
+        return None
+    mut.single_point_mutate()
+    return mut.out_product_smiles, mut.seed_stats()
+
+
+def mutation_header(df: pd.DataFrame, gen):
+    return list(df.columns) + ["smiles_gen_" + str(gen), "id_gen_" + str(gen), "reaction_id_gen_" + str(gen),
+                               "partner_gen_" + str(gen), "priority_gen_" + str(gen)]
+
+
+def mutate_seeds(df: pd.DataFrame, mutation: Mutation, cpu_num, gen):
+    # products of each seed are collected as a list in the last column
     mut_df = df.copy()
     if mut_df.shape[0] == 1:
         mut_df["smiles_gen_" + str(gen)] = mut_df["smiles_gen_" + str(gen - 1)].apply(
@@ -183,25 +788,87 @@ def mutation_df(df: pd.DataFrame, workdir, cpu_num, gen=1):
         mut_df["smiles_gen_" + str(gen)] = mut_df["smiles_gen_" + str(gen - 1)].parallel_apply(
             lambda x: mutation_per_row(mutation, x))
     mut_df = mut_df.dropna(subset=["smiles_gen_" + str(gen)]).reset_index(drop=True)
-    n = 1
+    seed_stats = mut_df["smiles_gen_" + str(gen)].apply(lambda x: x[1]).tolist()
+    mut_df["smiles_gen_" + str(gen)] = mut_df["smiles_gen_" + str(gen)].apply(lambda x: x[0])
+    write_mutation_report(mutation.workdir, mutation, seed_stats)
+    return mut_df
+
+
+def mutation_df(df: pd.DataFrame, workdir, cpu_num, gen=1, stream=False, seen=None, seed_cache=None,
+                profile=False, config_path=None, building_blocks=None):
+    workdir = os.path.join(workdir, "generation_" + str(gen))
+    mutation = Mutation(5000, workdir, seen, seed_cache, profile, gen=gen, config_path=config_path,
+                        building_blocks=building_blocks)
     mut_path = os.path.join(workdir, "mutation")
-    with open(mut_path + ".raw", "w") as f:
-        header = list(mut_df.columns[:-1]) + ["smiles_gen_" + str(gen), "id_gen_" + str(gen),
-                                              "reaction_id_gen_" + str(gen), "partner_gen_" + str(gen),
-                                              "priority_gen_" + str(gen)]
-        for i in mut_df.values.tolist():
-            last_gen_info = list(map(str, i[:-1]))
-            # keep parent mol
-            f.write(",".join(last_gen_info + [last_gen_info[0], last_gen_info[1].split("-dp")[0].split("-C")[0],
-                                              "Na-Na-Na", "", "3"]) + "\n")
-            # write mutation mols
-            for info in i[-1]:
-                info = list(map(str, info))
-                new_line = last_gen_info + [info[0]] + ["GEN_" + str(gen) + "_M_" + str(n).zfill(9)] + info[1:]
-                f.write(",".join(new_line) + "\n")
-                n += 1
+    shard_dir = os.path.join(workdir, "mutation_shards")
+    header = mutation_header(df, gen)
+
+    def mutation_per_seed(mut: Mutation, row):
+        # write products of each seed to its own shard, ids are built from seed index and product index
+        res = mutation_per_row(mut, row["smiles_gen_" + str(gen - 1)])
+        if res is None:
+            return None
+        prefix = "GEN_" + str(gen) + "_M_" + str(row.name).zfill(6) + "_"
+        with open(os.path.join(shard_dir, str(row.name).zfill(6) + ".csv"), "w") as f:
+            write_seed_lines(f, list(map(str, row.tolist())), res[0], lambda k: prefix + str(k + 1).zfill(7))
+        return res[1]
+
+    if stream:
+        # streaming mode, products never go back to the parent process
+        os.makedirs(shard_dir, exist_ok=True)
+        seed_df = df.reset_index(drop=True)
+        if seed_df.shape[0] == 1:
+            res = seed_df.apply(lambda x: mutation_per_seed(mutation, x), axis=1)
+        else:
+            pandarallel.initialize(verbose=0, nb_workers=cpu_num)
+            res = seed_df.parallel_apply(lambda x: mutation_per_seed(mutation, x), axis=1)
+        seed_stats = res.dropna().tolist()
+        write_mutation_report(workdir, mutation, seed_stats)
+        with open(mut_path + ".raw", "wb") as f:
+            for shard in sorted(os.listdir(shard_dir)):
+                with open(os.path.join(shard_dir, shard), "rb") as shard_f:
+                    shutil.copyfileobj(shard_f, f)
+        shutil.rmtree(shard_dir)
+    else:
+        mut_df = mutate_seeds(df, mutation, cpu_num, gen)
+        n = 1
+        with open(mut_path + ".raw", "w") as f:
+            for i in mut_df.values.tolist():
+                write_seed_lines(f, list(map(str, i[:-1])), i[-1],
+                                 lambda k: "GEN_" + str(gen) + "_M_" + str(n + k).zfill(9))
+                n += len(i[-1])
     # drop duplicates product smiles by awk
     cmd_dedup = "awk -F',' '!seen[$(NF-4)]++' " + mut_path + ".raw > " + mut_path + ".csv"
     subprocess.check_output(cmd_dedup, shell=True, stderr=subprocess.STDOUT)
 
     return header
+
+
+def mutation_frame(df: pd.DataFrame, workdir, cpu_num, gen=1, seen=None, seed_cache=None, profile=False,
+                   budget=None, config_path=None, rule_weights=None, spacer_ratio=None, building_blocks=None):
+    """
+    in memory version of mutation_df, return the deduplicated mutation rows as a DataFrame.
+    With a budget, products of each seed are enumerated lazily and only the ones passing the filter are kept.
+    """
+    workdir = os.path.join(workdir, "generation_" + str(gen))
+    if budget is not None:
+        # split the budget over seeds
+        budget = int(math.ceil(budget / max(df.shape[0], 1)))
+    mutation = Mutation(5000, workdir, seen, seed_cache, profile, budget, gen, config_path, rule_weights,
+                        spacer_ratio, building_blocks)
+    mut_df = mutate_seeds(df, mutation, cpu_num, gen)
+    rows = []
+    n = 1
+    for i in mut_df.values.tolist():
+        last_gen_info = i[:-1]
+        # keep parent mol
+        rows.append(last_gen_info + [last_gen_info[0], str(last_gen_info[1]).split("-dp")[0].split("-C")[0],
+                                     "Na-Na-Na", "", 3])
+        # mutation mols
+        for info in i[-1]:
+            rows.append(last_gen_info + [info[0], "GEN_" + str(gen) + "_M_" + str(n).zfill(9), info[1], info[2],
+                                         int(info[3])])
+            n += 1
+    gen_df = pd.DataFrame(rows, columns=mutation_header(df, gen))
+    # drop duplicates product smiles, keep the first one as awk does
+    return gen_df.drop_duplicates(subset="smiles_gen_" + str(gen), keep="first").reset_index(drop=True)
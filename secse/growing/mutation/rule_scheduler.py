@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: rule_scheduler.py
+@time: 2026/10/18/17:20
+"""
+import json
+import os
+import random
+
+from growing.mutation.mutation import SPACER_TABLE, get_spacer_ratio
+
+
+def rule_family(rule_id):
+    # same as the type column of filter.csv, e.g. G-001
+    return "-".join(rule_id.split("-")[:2])
+
+
+class RuleScheduler(object):
+    """
+    Thompson sampling over rule families. Each docked molecule is a trial of the family which made it,
+    the reward is 0.5 for passing the docking score/RMSD filter and 0.5 for being selected as a seed.
+    Older generations are discounted by decay.
+    """
+
+    def __init__(self, path, decay=0.8, min_weight=0.1):
+        self.path = path
+        self.decay = decay
+        self.min_weight = min_weight
+        self.history = {}
+        self.weights = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                state = json.load(f)
+            self.history = {int(k): v for k, v in state["history"].items()}
+            self.weights = {int(k): v for k, v in state["weights"].items()}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"history": self.history, "weights": self.weights}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def truncate(self, gen):
+        # forget generations after gen, e.g. when a run is restarted from an earlier generation
+        self.history = {k: v for k, v in self.history.items() if k <= gen}
+        self.weights = {k: v for k, v in self.weights.items() if k <= gen}
+        self.save()
+
+    def update(self, gen, docked_ids, improved_ids, seed_ids, id_family):
+        """
+        record trials and rewards of generation gen, id_family maps product id to its rule family
+        """
+        improved_ids = set(improved_ids)
+        seed_ids = set(seed_ids)
+        stats = {}
+        for i in set(docked_ids):
+            family = id_family.get(i)
+            # parent mols are kept without mutation
+            if family is None or family == "Na-Na":
+                continue
+            trials, reward = stats.get(family, (0, 0.0))
+            stats[family] = (trials + 1, reward + 0.5 * (i in improved_ids) + 0.5 * (i in seed_ids))
+        self.history[gen] = {k: list(v) for k, v in stats.items()}
+        self.save()
+
+    def posterior(self, gen):
+        # beta posterior of each family from generations up to gen
+        res = {}
+        for g, stats in self.history.items():
+            if g > gen:
+                continue
+            w = self.decay ** (gen - g)
+            for family, (trials, reward) in stats.items():
+                a, b = res.get(family, (1.0, 1.0))
+                res[family] = (a + w * reward, b + w * (trials - reward))
+        return res
+
+    def sample_weights(self, gen):
+        """
+        weights of rule families for generation gen, the mean over known families is 1,
+        families never docked before keep weight 1
+        """
+        draws = {k: random.betavariate(a, b) for k, (a, b) in self.posterior(gen - 1).items()}
+        weights = {}
+        if draws:
+            mean = sum(draws.values()) / len(draws)
+            weights = {k: max(self.min_weight, v / mean) if mean > 0 else 1.0 for k, v in draws.items()}
+        self.weights[gen] = weights
+        self.save()
+        return weights
+
+    @staticmethod
+    def spacer_ratio(gen, weights):
+        # stage dependent ratio of ring with spacer, scaled by the weight of G-002 against the other families
+        ratio = get_spacer_ratio(gen)
+        common = [v for k, v in weights.items() if k != SPACER_TABLE]
+        if SPACER_TABLE not in weights or not common:
+            return ratio
+        scaled = ratio * weights[SPACER_TABLE] / (sum(common) / len(common))
+        return min(max(scaled, 0.01), 0.5)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: seed_cache.py
+@time: 2026/10/18/14:05
+"""
+import json
+import sqlite3
+import time
+import zlib
+
+
+class SeedCache(object):
+    """
+    mutation products of seeds, keyed by canonical seed smiles and rule set version.
+    Shared by all runs on the same rule database, the least recently used seeds are evicted.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    def conn(self):
+        # one connection per process
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("pragma journal_mode=wal")
+            self._conn.execute("create table if not exists seeds (seed text, rules text, products blob, "
+                               "last_used real, primary key (seed, rules)) without rowid")
+            self._conn.execute("create index if not exists seeds_last_used on seeds (last_used)")
+        return self._conn
+
+    def get(self, seed, rules):
+        conn = self.conn()
+        row = conn.execute("select products from seeds where seed = ? and rules = ?", (seed, rules)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("update seeds set last_used = ? where seed = ? and rules = ?", (time.time(), seed, rules))
+        return [tuple(i) for i in json.loads(zlib.decompress(row[0]))]
+
+    def put(self, seed, rules, products):
+        conn = self.conn()
+        with conn:
+            conn.execute("insert or replace into seeds values (?, ?, ?, ?)",
+                         (seed, rules, zlib.compress(json.dumps(products).encode()), time.time()))
+
+    def evict(self):
+        conn = self.conn()
+        with conn:
+            conn.execute("delete from seeds where last_used < (select last_used from seeds order by last_used desc "
+                         "limit 1 offset ?)", (self.max_entries - 1,))
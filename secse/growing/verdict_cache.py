@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: verdict_cache.py
+@time: 2026/10/18/22:50
+"""
+import queue
+import sqlite3
+import threading
+import time
+
+# smiles per select statement, below the sqlite limit of host parameters
+LOOKUP_BATCH = 500
+
+
+class VerdictCache(object):
+    """
+    filter flags keyed by canonical product smiles and filter key, see filter_verdict_key,
+    with the descriptors of mols passing the filter as written to descriptors.csv.
+    Shared by all runs with the same filter settings, the least recently used verdicts are evicted.
+    New verdicts are written by a background thread of the main process, workers only read.
+    """
+
+    def __init__(self, path, max_entries=5000000):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._queue = None
+        self._writer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_queue"] = None
+        state["_writer"] = None
+        return state
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("pragma journal_mode=wal")
+        conn.execute("create table if not exists verdicts (smiles text, key text, flag text, last_used real, "
+                     "descriptors text, primary key (smiles, key)) without rowid")
+        if "descriptors" not in [i[1] for i in conn.execute("pragma table_info(verdicts)")]:
+            # caches written before descriptors were kept
+            conn.execute("alter table verdicts add column descriptors text")
+        conn.execute("create index if not exists verdicts_last_used on verdicts (last_used)")
+        return conn
+
+    def conn(self):
+        # one connection per process
+        if self._conn is None:
+            self._conn = self.connect()
+        return self._conn
+
+    def disconnect(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_many(self, smiles_list, key, with_descriptors=False):
+        """
+        flags of the smiles found in the cache, and their stored descriptors if with_descriptors
+        """
+        conn = self.conn()
+        smiles_list = list(smiles_list)
+        res = {}
+        descriptors = {}
+        for i in range(0, len(smiles_list), LOOKUP_BATCH):
+            batch = smiles_list[i:i + LOOKUP_BATCH]
+            rows = conn.execute("select smiles, flag, descriptors from verdicts where key = ? and smiles in ({})".format(
+                ",".join("?" * len(batch))), [key] + batch)
+            for smi, flag, desc in rows:
+                res[smi] = flag
+                if desc is not None:
+                    descriptors[smi] = desc
+        if with_descriptors:
+            return res, descriptors
+        return res
+
+    @staticmethod
+    def put_many(conn, verdicts, key, touched=(), descriptors=None):
+        now = time.time()
+        descriptors = descriptors or {}
+        with conn:
+            conn.executemany("insert or replace into verdicts (smiles, key, flag, last_used, descriptors) "
+                             "values (?, ?, ?, ?, ?)",
+                             [(k, key, v, now, descriptors.get(k)) for k, v in verdicts.items()])
+            conn.executemany("update verdicts set last_used = ? where smiles = ? and key = ?",
+                             [(now, i, key) for i in touched])
+
+    def start(self):
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        # sqlite connections can not be shared between threads
+        conn = self.connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self.put_many(conn, *item)
+        conn.close()
+
+    def write(self, verdicts, key, touched=(), descriptors=None):
+        if self._writer is not None:
+            self._queue.put((verdicts, key, touched, descriptors))
+        else:
+            self.put_many(self.conn(), verdicts, key, touched, descriptors)
+
+    def close(self):
+        # wait until all verdicts are written
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._queue = None
+            self._writer = None
+
+    def evict(self):
+        conn = self.conn()
+        with conn:
+            conn.execute("delete from verdicts where last_used < (select last_used from verdicts "
+                         "order by last_used desc limit 1 offset ?)", (self.max_entries - 1,))
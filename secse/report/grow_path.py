@@ -5,19 +5,20 @@
 @file: grow_path.py 
 @time: 2021/01/19/13:42
 """
+import glob
 import os
 import time
 import argparse
 import numpy as np
 import pandas as pd
 from rdkit import Chem
-from rdkit.Chem import Descriptors
-from rdkit.Chem.rdMolDescriptors import CalcExactMolWt
 import subprocess
 from pandarallel import pandarallel
 import configparser
 
 from scoring.ranking import read_dock_file
+from uitilities.descriptors import batch_descriptors
+from uitilities.filter_bundle import load_filter_bundle
 
 pandarallel.initialize(verbose=0)
 
@@ -81,23 +82,41 @@ def grow_path(mut_dic_all, mut_id):
     return mut_info_lst
 
 
-def add_prop(merged_df_path):
+def load_descriptors(workdir):
+    # descriptors kept by the filter step, keyed by smiles
+    desc_files = sorted(glob.glob(os.path.join(workdir, "generation_*", "descriptors.csv")))
+    if not desc_files:
+        return pd.DataFrame(columns=["MW", "LogP"])
+    desc_df = pd.concat([pd.read_csv(i, usecols=["smiles", "MW", "LogP"], float_precision="round_trip")
+                         for i in desc_files], axis=0)
+    return desc_df.drop_duplicates(subset=["smiles"]).set_index("smiles")
+
+
+def add_prop(merged_df_path, workdir=None):
     merged_df = pd.read_csv(merged_df_path)
     raw_cols = list(merged_df.columns)
     merged_df["mol"] = merged_df["smiles"].apply(Chem.MolFromSmiles)
     # check charge
     merged_df["charge flag"] = merged_df["mol"].apply(charge_filter)
     merged_df = merged_df[merged_df["charge flag"]]
-    # add MW, logP
-    merged_df["MW"] = merged_df["mol"].apply(CalcExactMolWt)
-    merged_df["LogP"] = merged_df["mol"].apply(Descriptors.MolLogP)
+    # add MW, logP, reuse the values of the filter step and compute the others in one batch
+    desc_df = load_descriptors(workdir) if workdir is not None else pd.DataFrame(columns=["MW", "LogP"])
+    known = merged_df["smiles"].isin(desc_df.index).to_numpy()
+    mw = np.full(merged_df.shape[0], np.nan)
+    logp = np.full(merged_df.shape[0], np.nan)
+    mw[known] = desc_df.loc[merged_df["smiles"][known], "MW"].to_numpy()
+    logp[known] = desc_df.loc[merged_df["smiles"][known], "LogP"].to_numpy()
+    desc = batch_descriptors(merged_df["mol"][~known].tolist())
+    mw[~known] = desc["MW"]
+    logp[~known] = desc["LogP"]
+    merged_df["MW"] = mw
+    merged_df["LogP"] = logp
     new_cols = ["smiles", "MW", "LogP"] + raw_cols[1:]
     return merged_df[new_cols]
 
 
 def charge_filter(mol):
-    negative_charge = Chem.MolFromSmarts("[*-1]")
-    positive_charge = Chem.MolFromSmarts("[*+1]")
+    negative_charge, positive_charge = load_filter_bundle()["charge"]
     nc = len(mol.GetSubstructMatches(negative_charge))
     pc = len(mol.GetSubstructMatches(positive_charge))
     npc = nc + pc
@@ -166,7 +185,7 @@ def write_growth(max_gen: int, workdir: str, dl_mode: int, config_path: str):
                 new_line += "," * (cols - new_line.count(",")) + "\n"
                 new.write(new_line)
 
-    grow_df = add_prop(new_file)
+    grow_df = add_prop(new_file, workdir)
     grow_df.to_csv(final_file, index=False)
     grep_sdf(workdir, final_file)
     print("\n", "*" * 100)
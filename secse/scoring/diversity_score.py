@@ -26,20 +26,157 @@ def tanimoto_smi(fp1, fp2):
     return rdkit.DataStructs.cDataStructs.TanimotoSimilarity(fp1, fp2)
 
 
+# number of set bits of each byte, for numpy without bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(arr):
+    # set bits of each row of a uint64 matrix
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(arr).sum(axis=1, dtype=np.int64)
+    return _POPCOUNT_TABLE[arr.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def fp_matrix(fps):
+    """
+    fingerprints packed into a uint64 matrix, one row per fingerprint
+    """
+    fps = list(fps)
+    words = (fps[0].GetNumBits() + 63) // 64 if fps else 1
+    text = "".join(rdkit.DataStructs.BitVectToFPSText(fp).ljust(words * 16, "0") for fp in fps)
+    return np.frombuffer(bytes.fromhex(text), dtype=np.uint64).reshape(len(fps), words)
+
+
+def rows_tanimoto(rows, other, counts, other_counts):
+    # Tanimoto similarity of packed fingerprints row by row, other may be a single row
+    common = popcount(rows & other)
+    union = counts + other_counts - common
+    res = np.zeros(rows.shape[0])
+    np.divide(common, union, out=res, where=union > 0)
+    return res
+
+
+def bulk_tanimoto(center, matrix, counts):
+    """
+    Tanimoto similarity of row center to all rows of matrix, same values as TanimotoSimilarity
+    """
+    return rows_tanimoto(matrix, matrix[center], counts, counts[center])
+
+
+def fp_minhash(smi, perms):
+    """
+    packed Morgan fingerprint followed by its MinHash signature, the smallest rank of an on bit
+    under each permutation of bit positions
+    """
+    fp = cal_morgan_fp(smi)
+    on_bits = list(fp.GetOnBits())
+    if on_bits:
+        sig = perms[:, on_bits].min(axis=1)
+    else:
+        sig = np.full(perms.shape[0], perms.shape[1], dtype=np.uint16)
+    return bytes.fromhex(rdkit.DataStructs.BitVectToFPSText(fp)) + sig.astype(np.uint16).tobytes()
+
+
+def lsh_clustering(df: pd.DataFrame, smi, gen, cpu_num, k=500, bands=6, rows=3):
+    """
+    approximate version of clustering for millions of mols, linear in the number of mols.
+    MinHash signatures are split into bands, mols sharing the bucket of a band are candidates of each other.
+    Mols in random order become centers unless a center in their buckets has similarity >= 0.6,
+    each mol is assigned to the most similar center found in its buckets. Mols sharing no bucket with any center
+    are compared with all centers. Bucket keys hold at most 6 rows.
+    """
+    df = df.reset_index(drop=True)
+    n = df.shape[0]
+    words = 8
+    perms = np.array([np.random.permutation(words * 64) for _ in range(bands * rows)], dtype=np.uint16)
+    pandarallel.initialize(verbose=0, nb_workers=cpu_num)
+    packed = np.frombuffer(b"".join(df[smi].parallel_apply(lambda x: fp_minhash(x, perms))), dtype=np.uint8)
+    packed = packed.reshape(n, words * 8 + bands * rows * 2)
+    matrix = np.ascontiguousarray(packed[:, :words * 8]).view(np.uint64)
+    sig = np.ascontiguousarray(packed[:, words * 8:]).view(np.uint16).astype(np.int64)
+    counts = popcount(matrix)
+    # bucket of each mol per band, signature values are below 1024
+    shifts = np.arange(rows, dtype=np.int64) * 10
+    keys = [(sig[:, b * rows:(b + 1) * rows] << shifts).sum(axis=1) for b in range(bands)]
+
+    # pick centers
+    centers = []
+    tables = [dict() for _ in range(bands)]
+    for i in np.random.permutation(n):
+        cand = set()
+        for b in range(bands):
+            cand.update(tables[b].get(keys[b][i], ()))
+        if cand:
+            cand = np.array(sorted(cand))
+            if rows_tanimoto(matrix[cand], matrix[i], counts[cand], counts[i]).max() >= 0.6:
+                continue
+        for b in range(bands):
+            tables[b].setdefault(keys[b][i], []).append(i)
+        centers.append(i)
+        if len(centers) >= k:
+            break
+    centers = np.array(centers, dtype=np.int64)
+
+    # assign mols to the most similar center sharing a bucket, the first picked center wins a tie
+    best_pos = np.full(n, -1, dtype=np.int64)
+    best_sim = np.full(n, -np.inf)
+    for b in range(bands):
+        center_keys = keys[b][centers]
+        order = np.argsort(center_keys, kind="stable")
+        center_keys = center_keys[order]
+        lo = np.searchsorted(center_keys, keys[b], "left")
+        hi = np.searchsorted(center_keys, keys[b], "right")
+        d = 0
+        while True:
+            sel = np.nonzero(lo + d < hi)[0]
+            if len(sel) == 0:
+                break
+            pos = order[lo[sel] + d]
+            sims = rows_tanimoto(matrix[sel], matrix[centers[pos]], counts[sel], counts[centers[pos]])
+            closer = (sims > best_sim[sel]) | ((sims == best_sim[sel]) & (pos < best_pos[sel]))
+            best_pos[sel[closer]] = pos[closer]
+            best_sim[sel[closer]] = sims[closer]
+            d += 1
+
+    outliers = np.nonzero(best_pos < 0)[0]
+    if len(outliers) and len(centers):
+        for pos, c in enumerate(centers):
+            sims = rows_tanimoto(matrix[outliers], matrix[c], counts[outliers], counts[c])
+            closer = sims > best_sim[outliers]
+            best_pos[outliers[closer]] = pos
+            best_sim[outliers[closer]] = sims[closer]
+    found = best_pos >= 0
+    best_center = np.full(n, -1, dtype=np.int64)
+    best_center[found] = centers[best_pos[found]]
+    best_sim[~found] = 0.0
+    print("LSH picker: {} centers, {} of {} mols shared no bucket with a center.".format(len(centers),
+                                                                                        len(outliers), n))
+    df["cluster_center_gen_" + str(gen)] = best_center
+    df["cluster_center_dis_gen_" + str(gen)] = best_sim
+    return df
+
+
 def clustering(df: pd.DataFrame, smi, gen, cpu_num, k=500):
     df = df.reset_index(drop=True)
     pandarallel.initialize(verbose=0, nb_workers=cpu_num)
     df["fp2"] = df[smi].parallel_apply(cal_morgan_fp)
     df = df.dropna(subset=["fp2"])
+    # similarities of all mols to a center are computed at once on the packed fingerprints
+    matrix = fp_matrix(df["fp2"])
+    counts = popcount(matrix)
     c = df["fp2"].sample(1)
     c_next = c.index[0]
-    c = c.iloc[0]
+    c = df.index.get_loc(c_next)
     c_lst = []
     dis = np.zeros(df.shape[0])
-    dis_dic = dict()
+    # nearest center of each mol so far, the first center wins a tie
+    best_center = np.full(df.shape[0], c_next, dtype=np.int64)
+    best_sim = np.full(df.shape[0], -np.inf)
     for i in range(k):
-        new_dis = np.array(df["fp2"].apply(lambda x: tanimoto_smi(c, x)))
-        dis_dic[c_next] = new_dis.copy()
+        new_dis = bulk_tanimoto(c, matrix, counts)
+        closer = new_dis > best_sim
+        best_center[closer] = c_next
+        best_sim[closer] = new_dis[closer]
         # mask mols with similarity larger than 0.6, those mols with not be consider as cluster center in next loops
         new_dis[new_dis >= 0.6] = 999999999
         dis += new_dis
@@ -47,12 +184,11 @@ def clustering(df: pd.DataFrame, smi, gen, cpu_num, k=500):
             break
         else:
             c_next = np.argmin(dis)
-            c = df["fp2"].iloc[c_next]
+            c = c_next
             c_lst.append(c_next)
 
-    df_cluster = pd.DataFrame(dis_dic)
-    df["cluster_center_gen_" + str(gen)] = df_cluster.parallel_apply(lambda x: x.nlargest(1).index[0], axis=1)
-    df["cluster_center_dis_gen_" + str(gen)] = df_cluster.parallel_apply(lambda x: x.nlargest(1).iloc[0], axis=1)
+    df["cluster_center_gen_" + str(gen)] = best_center
+    df["cluster_center_dis_gen_" + str(gen)] = best_sim
     df = df.drop(columns="fp2")
     return df
 
@@ -12,6 +12,8 @@ import os
 import configparser
 from pandarallel import pandarallel
 
+from uitilities.mol_store import get_mol_store
+
 pandarallel.initialize(verbose=0)
 rdkit.RDLogger.DisableLog("rdApp.*")
 
@@ -69,9 +71,13 @@ class Ranking(object):
             ["ID", "Molecule", "smiles", "docking score"]]
         raw_df["docking score"] = raw_df["docking score"].astype(float)
         raw_df = raw_df.sort_values(by="docking score", ascending=True)
-        raw_df["le_ln"] = raw_df.apply(
-            lambda x: x["docking score"] / Chem.MolFromSmiles(x["smiles"]).GetNumHeavyAtoms(),
-            axis=1)
+        # heavy atoms of the docked mol, stereoisomers and tautomers of an id share the count of the stored mol
+        mol_store = get_mol_store()
+        base_id = raw_df["ID"].apply(lambda x: x.split("-dp")[0].split("-C")[0])
+        heavy_atoms = mol_store.heavy_atoms_by_id(base_id) if mol_store is not None else {}
+        raw_df["le_ln"] = [score / heavy_atoms[i] if i in heavy_atoms else
+                           score / Chem.MolFromSmiles(smi).GetNumHeavyAtoms()
+                           for score, i, smi in zip(raw_df["docking score"], base_id, raw_df["smiles"])]
 
         raw_df.columns = [i.lower() for i in list(raw_df.columns)]
 
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: descriptors.py
+@time: 2026/10/18/22:10
+"""
+import numpy as np
+from rdkit.Chem import Descriptors
+from rdkit.Chem.rdMolDescriptors import CalcExactMolWt, CalcNumHBD, CalcNumHBA, CalcNumHeteroatoms
+
+DESCRIPTOR_NAMES = ["MW", "HBD", "HBA", "LogP", "TPSA", "heteroatom_ratio"]
+
+
+def mol_descriptors(mol):
+    heavy = mol.GetNumHeavyAtoms()
+    return (CalcExactMolWt(mol), CalcNumHBD(mol), CalcNumHBA(mol), Descriptors.MolLogP(mol),
+            Descriptors.TPSA(mol), CalcNumHeteroatoms(mol) / heavy if heavy > 0 else np.inf)
+
+
+def batch_descriptors(mols):
+    """
+    descriptors of a chunk of mols as one array per descriptor, NaN for mols which are None
+    """
+    values = np.full((len(mols), len(DESCRIPTOR_NAMES)), np.nan)
+    for n, mol in enumerate(mols):
+        if mol is not None:
+            values[n] = mol_descriptors(mol)
+    return {k: values[:, n] for n, k in enumerate(DESCRIPTOR_NAMES)}
+
+
+def property_label(desc, mw, logp_lower, logp_upper, gen):
+    """
+    first failed property of a mol in the order of Filter.pp_filter, PASS if none failed
+    """
+    if desc["MW"] > mw or (gen > 3 and desc["MW"] < 81):
+        return "MW"
+    if desc["HBD"] > 5:
+        return "HBD"
+    if desc["HBA"] > 10:
+        return "HBA"
+    if desc["LogP"] < logp_lower or desc["LogP"] > logp_upper:
+        return "cLogP"
+    if desc["TPSA"] > 200:
+        return "TPSA"
+    return "PASS"
+
+
+def lipinski_violations(desc):
+    # number of Lipinski rule of five violations
+    return int(desc["MW"] >= 500) + int(desc["HBD"] >= 5) + int(desc["HBA"] >= 10) + int(desc["LogP"] > 5)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: filter_bundle.py
+@time: 2026/10/18/20:15
+"""
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+from rdkit import Chem
+
+FILTER_BUNDLE_VERSION = 1
+FILTER_BUNDLE_DIR = os.path.join(os.getenv("SECSE"), "uitilities", "compiled")
+STRUCTURE_FILTER_FILE = os.path.join(os.getenv("SECSE"), "uitilities", "Structure Filter_20211015_v1.12.xls")
+PAINS_FILE = os.path.join(os.getenv("SECSE"), "growing", "pains_smarts.json")
+CHARGE_SMARTS = ("[*-1]", "[*+1]")
+ROTATABLE_SMARTS = '[C^3!D1;!$(C(F)(F)F)]-!@[!Br!F!Cl!I!H3&!$(*#*)!D1;!$([!Br!F!Cl!I](F)(F)F)]'
+RIGID_SMARTS = "[C^3!D1;!$(C(F)(F)F);!R;!$(C=O(N));!$(NC(=O));!$(C(=O)O);!$(C(=O)O)]-!@[!Br!F!Cl!I!H3&!$(*#*)!D1;" \
+               "!$([!Br!F!Cl!I](F)(F)F);!R;!$(C=O([N,O]));!$(NC(=O));!$(C(=O)O)]"
+
+# filter bundles already loaded in this process
+_FILTER_BUNDLES = {}
+
+
+def filter_bundle_key():
+    md5 = hashlib.md5()
+    for path in [STRUCTURE_FILTER_FILE, PAINS_FILE]:
+        with open(path, "rb") as f:
+            md5.update(f.read())
+    md5.update("\n".join(CHARGE_SMARTS + (ROTATABLE_SMARTS, RIGID_SMARTS)).encode())
+    md5.update(str(FILTER_BUNDLE_VERSION).encode())
+    return md5.hexdigest()
+
+
+def compile_filter_bundle(key):
+    df = pd.read_excel(STRUCTURE_FILTER_FILE, usecols=["Pattern", "ID", "Max"]).dropna()
+    df = df.set_index("ID")
+    df["Pattern_sma"] = df["Pattern"].apply(lambda x: Chem.MolFromSmarts(x))
+    with open(PAINS_FILE) as f:
+        pains = json.load(f)
+    return {"key": key,
+            "structure": df[["Pattern_sma", "Max"]].T.to_dict(),
+            "pains": dict((k, Chem.MolFromSmarts(v)) for k, v in pains.items()),
+            "charge": tuple(Chem.MolFromSmarts(i) for i in CHARGE_SMARTS),
+            "rotatable": Chem.MolFromSmarts(ROTATABLE_SMARTS),
+            "rigid": Chem.MolFromSmarts(RIGID_SMARTS)}
+
+
+def load_filter_bundle():
+    """
+    compiled structure filter, PAINS, charge and rotatable bond patterns,
+    compiled from the source files only if no bundle was built for them before
+    """
+    stats = tuple((os.stat(i).st_mtime, os.stat(i).st_size) for i in [STRUCTURE_FILTER_FILE, PAINS_FILE])
+    if stats in _FILTER_BUNDLES:
+        return _FILTER_BUNDLES[stats]
+
+    key = filter_bundle_key()
+    bundle_path = os.path.join(FILTER_BUNDLE_DIR, "filter_{}.pkl".format(key))
+    bundle = None
+    if os.path.exists(bundle_path):
+        try:
+            with open(bundle_path, "rb") as f:
+                bundle = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            bundle = None
+    if bundle is None:
+        bundle = compile_filter_bundle(key)
+        try:
+            os.makedirs(FILTER_BUNDLE_DIR, exist_ok=True)
+            # write to a temporary file first, so that concurrent runs never read a partial bundle
+            tmp_path = bundle_path + ".{}.tmp".format(os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, bundle_path)
+        except OSError as e:
+            print("Can not write compiled filters: {}".format(e))
+    _FILTER_BUNDLES[stats] = bundle
+    return bundle
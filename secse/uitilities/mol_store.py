@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: mol_store.py
+@time: 2026/10/18/23:40
+"""
+import os
+import sqlite3
+
+from rdkit import Chem
+
+# smiles per select statement, below the sqlite limit of host parameters
+LOOKUP_BATCH = 500
+# environment variable pointing stages running in other processes to the store of the run
+MOL_STORE_ENV = "SECSE_MOL_STORE"
+
+
+def chunks(items, size=LOOKUP_BATCH):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class MolStore(object):
+    """
+    parsed mols to dock with their heavy atom count, keyed by smiles, plus the smiles of each molecule id.
+    The main process registers the ids to dock, mols are stored by the LigPrep processes which parse them anyway
+    and are read again by later docking and ranking stages.
+    Readers in worker processes open their own connection, a mol is rebuilt from its binary pickle without parsing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    def conn(self):
+        # one connection per process
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("pragma journal_mode=wal")
+            self._conn.execute("create table if not exists mols (smiles text primary key, mol blob, "
+                               "heavy_atoms integer) without rowid")
+            self._conn.execute("create table if not exists ids (id text primary key, smiles text) without rowid")
+        return self._conn
+
+    def add_ids(self, ids, smiles_list):
+        with self.conn() as conn:
+            conn.executemany("insert or replace into ids values (?, ?)", zip(ids, smiles_list))
+
+    def add_smi_file(self, path):
+        # tab separated smiles and id, as written for docking
+        smiles_list = []
+        ids = []
+        with open(path, "r") as f:
+            for line in f:
+                tmp = line.strip().split("\t")
+                if len(tmp) < 2:
+                    continue
+                smiles_list.append(tmp[0])
+                ids.append(tmp[1])
+        self.add_ids(ids, smiles_list)
+
+    def add_mols(self, mols):
+        """
+        store mols parsed by the caller, keyed by smiles, mols stored before are kept
+        """
+        with self.conn() as conn:
+            conn.executemany("insert or ignore into mols values (?, ?, ?)",
+                             [(k, v.ToBinary(), v.GetNumHeavyAtoms()) for k, v in mols.items()])
+
+    def get_mols(self, smiles_list):
+        res = {}
+        for batch in chunks(set(smiles_list)):
+            rows = self.conn().execute("select smiles, mol from mols where smiles in ({})".format(
+                ",".join("?" * len(batch))), batch)
+            res.update((i[0], Chem.Mol(i[1])) for i in rows)
+        return res
+
+    def heavy_atoms_by_id(self, ids):
+        res = {}
+        for batch in chunks(set(ids)):
+            rows = self.conn().execute("select ids.id, mols.heavy_atoms from ids join mols on ids.smiles = "
+                                       "mols.smiles where ids.id in ({})".format(",".join("?" * len(batch))), batch)
+            res.update(rows)
+        return res
+
+
+def get_mol_store():
+    # store of the running job, None if the run does not keep one
+    path = os.getenv(MOL_STORE_ENV)
+    if not path or not os.path.exists(path):
+        return None
+    return MolStore(path)
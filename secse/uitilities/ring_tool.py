@@ -8,115 +8,90 @@
 from rdkit import Chem
 
 
+def bit_count(x):
+    return bin(x).count("1")
+
+
+def bit_indices(x):
+    res = []
+    while x:
+        low = x & -x
+        res.append(low.bit_length() - 1)
+        x ^= low
+    return res
+
+
 def ring_site_count(ring_atoms, systems):
+    # ring atoms and systems are atom bitsets
     site_count = [-1]  # add -1 in case no ring site
     for ring_s in systems:
-        ring_s = set(ring_s)
-        count = 0
-        for site in ring_atoms:
-            site = set(site)
-            if ring_s.intersection(site):
-                count += 1
-        site_count.append(count)
+        site_count.append(sum(1 for site in ring_atoms if ring_s & site))
     return site_count
 
 
 class RingSystems(object):
+    """
+    rings and ring systems are kept as integer bitsets of atom or bond indices
+    """
+
     def __init__(self, mol):
         self.mol = mol
         self.ri = self.mol.GetRingInfo()
-        self.atom_rings = self.ri.AtomRings()
-        self.bond_rings = self.ri.BondRings()
+        self.atom_rings = [sum(1 << a for a in ring) for ring in self.ri.AtomRings()]
+        self.bond_rings = [sum(1 << b for b in ring) for ring in self.ri.BondRings()]
         self.systems = self.ring_systems()
 
     def ring_systems(self):
         systems = []
-        for ring in self.atom_rings:
-            ringAts = set(ring)
-            nSystems = []
+        for ring_ats in self.atom_rings:
+            n_systems = []
             for system in systems:
-                nInCommon = len(ringAts.intersection(system))
-                if nInCommon:
-                    ringAts = ringAts.union(system)
+                if ring_ats & system:
+                    ring_ats |= system
                 else:
-                    nSystems.append(system)
-            nSystems.append(ringAts)
-            systems = nSystems
+                    n_systems.append(system)
+            n_systems.append(ring_ats)
+            systems = n_systems
         return systems
 
     # ring size of each ring system
     def ring_systems_size(self):
-        ring_sys_size = []
-        for ring_s in self.systems:
-            ring_s = set(ring_s)
-            size = 0
-            for ring in self.atom_rings:
-                ring = set(ring)
-                if ring_s.intersection(ring):
-                    size += 1
-            ring_sys_size.append(size)
-        return ring_sys_size
+        return [sum(1 for ring in self.atom_rings if ring_s & ring) for ring_s in self.systems]
 
     def get_spiro_atoms(self):
-        spiro = []
         spiro_atoms = set()
         for i in range(len(self.atom_rings)):
-            atom_ring_i = set(self.atom_rings[i])
             for j in range(i):
-                atom_ring_j = set(self.atom_rings[j])
-                common_atoms = atom_ring_i.intersection(atom_ring_j)
-                if len(common_atoms) == 1:
-                    atoms = [0] * len(self.mol.GetAtoms())
-                    for a in common_atoms:
-                        atoms[a] += 1
-
-                    for idx in range(len(atoms)):
-                        if atoms[idx] == 1:
-                            spiro = (idx,)
-                    spiro_atoms.add(spiro)
+                common_atoms = self.atom_rings[i] & self.atom_rings[j]
+                if common_atoms and not common_atoms & (common_atoms - 1):
+                    spiro_atoms.add(common_atoms)
         return spiro_atoms
 
+    def shared_bond_atoms(self, common_bonds):
+        # atoms at the ends of the shared bonds, i.e. in exactly one of them
+        counts = {}
+        for b in bit_indices(common_bonds):
+            bond = self.mol.GetBondWithIdx(b)
+            for a in (bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()):
+                counts[a] = counts.get(a, 0) + 1
+        return sum(1 << a for a, c in counts.items() if c == 1)
+
     def get_fused_atoms(self):
         fused_atoms = set()
-
         for i in range(len(self.bond_rings)):
-            bond_ring_i = set(self.bond_rings[i])
             for j in range(i):
-                bond_ring_j = set(self.bond_rings[j])
-                common_bonds = bond_ring_i.intersection(bond_ring_j)
-                if len(common_bonds) == 1:
-                    atoms = [0] * len(self.mol.GetAtoms())
-                    fused_unit = ()
-
-                    for b in common_bonds:
-                        atoms[self.mol.GetBondWithIdx(b).GetBeginAtomIdx()] += 1
-                        atoms[self.mol.GetBondWithIdx(b).GetEndAtomIdx()] += 1
-                    for idx in range(len(atoms)):
-                        if atoms[idx] == 1:
-                            fused_unit += (idx,)
-                    fused_atoms.add(fused_unit)
-
+                common_bonds = self.bond_rings[i] & self.bond_rings[j]
+                if common_bonds and not common_bonds & (common_bonds - 1):
+                    fused_atoms.add(self.shared_bond_atoms(common_bonds))
         return fused_atoms
 
     def get_bridged_atoms(self):
         bridged_atoms = set()
-
         for i in range(len(self.bond_rings)):
-            bond_ring_i = set(self.bond_rings[i])
             for j in range(i):
-                bond_ring_j = set(self.bond_rings[j])
-                common_bonds = bond_ring_i.intersection(bond_ring_j)
-
-                if len(common_bonds) > 1:
-                    atoms = [0] * len(self.mol.GetAtoms())
-                    bridged_unit = ()
-                    for b in common_bonds:
-                        atoms[self.mol.GetBondWithIdx(b).GetBeginAtomIdx()] += 1
-                        atoms[self.mol.GetBondWithIdx(b).GetEndAtomIdx()] += 1
-                    for idx in range(len(atoms)):
-                        if atoms[idx] == 1:
-                            bridged_unit += (idx,)
-                    bridged_atoms.add(bridged_unit)
+                common_bonds = self.bond_rings[i] & self.bond_rings[j]
+                if bit_count(common_bonds) > 1:
+                    bridged_atoms.add(self.shared_bond_atoms(common_bonds))
         return bridged_atoms
 
     def spiro_site_count(self):
@@ -140,25 +115,36 @@ class RingSystems(object):
     def largest_fused_site_filter(self, num=3):
         return max(self.fused_site_count()) <= num
 
-    def largest_bridged_site_filter(self, num=2):
-        return max(self.bridged_site_count()) <= num
+    def largest_bridged_site_filter(self, num=2, bridged_atoms=None):
+        if bridged_atoms is None:
+            bridged_atoms = self.get_bridged_atoms()
+        return max(ring_site_count(bridged_atoms, self.systems)) <= num
 
-    def bridged_atom_is_aromatic_filter(self):
-        bridged_atoms = self.get_bridged_atoms()
+    def bridged_atom_is_aromatic_filter(self, bridged_atoms=None):
+        if bridged_atoms is None:
+            bridged_atoms = self.get_bridged_atoms()
         for atom_cubic in bridged_atoms:
-            for atom_idx in atom_cubic:
+            for atom_idx in bit_indices(atom_cubic):
                 atom = self.mol.GetAtomWithIdx(atom_idx)
                 if atom.GetIsAromatic():
                     return False
         return True
 
     def ring_check(self):
-        return all([self.largest_ring_system_size_filter(),
-                    self.largest_bridged_site_filter(),
-                    self.largest_spiro_site_filter(),
-                    self.largest_fused_site_filter(),
-                    self.ring_system_count_filter(),
-                    self.bridged_atom_is_aromatic_filter()])
+        # cheapest checks first, bridged atoms are only searched once
+        if not (self.ring_system_count_filter() and self.largest_ring_system_size_filter() and
+                self.largest_spiro_site_filter() and self.largest_fused_site_filter()):
+            return False
+        bridged_atoms = self.get_bridged_atoms()
+        return self.largest_bridged_site_filter(bridged_atoms=bridged_atoms) and \
+            self.bridged_atom_is_aromatic_filter(bridged_atoms)
+
+
+def ring_check(mol):
+    # a single ring passes all ring system checks, no need to look at the rings
+    if mol.GetRingInfo().NumRings() <= 1:
+        return True
+    return RingSystems(mol).ring_check()
 
 
 if __name__ == '__main__':
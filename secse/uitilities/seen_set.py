@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: seen_set.py
+@time: 2026/10/18/10:12
+"""
+import hashlib
+import math
+import os
+import sqlite3
+
+# bloom filter bits already loaded in this process, forked workers inherit them from the parent
+_BLOOM_BITS = {}
+
+
+def bloom_size(capacity, error_rate):
+    num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    num_bits = max(8, (num_bits + 7) // 8 * 8)
+    num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+    return num_bits, num_hashes
+
+
+class SeenSet(object):
+    """
+    molecules generated in former generations of a run, a bloom filter in memory answers most queries and
+    an exact sqlite store confirms the possible hits. The memory usage only depends on the capacity.
+    """
+
+    def __init__(self, path, capacity=20000000, error_rate=0.01):
+        self.path = path
+        self.db_path = os.path.join(path, "seen.db")
+        self.bloom_path = os.path.join(path, "seen.bloom")
+        self.num_bits, self.num_hashes = bloom_size(capacity, error_rate)
+        self.bits = None
+        self._conn = None
+        os.makedirs(self.path, exist_ok=True)
+        self.load_bloom()
+
+    def __getstate__(self):
+        # do not pickle the bloom filter into pandarallel workers
+        state = self.__dict__.copy()
+        state["bits"] = None
+        state["_conn"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_bloom()
+
+    def load_bloom(self):
+        self.bits = _BLOOM_BITS.get(self.bloom_path)
+        if self.bits is not None and len(self.bits) * 8 == self.num_bits:
+            return
+        self.bits = bytearray(self.num_bits // 8)
+        if os.path.exists(self.bloom_path) and os.path.getsize(self.bloom_path) == len(self.bits):
+            with open(self.bloom_path, "rb") as f:
+                f.readinto(self.bits)
+        elif os.path.exists(self.db_path):
+            # capacity changed or bloom file lost, rebuild from the exact store
+            self.rebuild()
+        _BLOOM_BITS[self.bloom_path] = self.bits
+
+    def rebuild(self):
+        self.bits[:] = bytes(len(self.bits))
+        for (smi,) in self.conn().execute("select smiles from seen"):
+            self.set_bits(smi)
+
+    def conn(self):
+        # one connection per process
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=60)
+            self._conn.execute("create table if not exists seen (smiles text primary key, gen integer) without rowid")
+        return self._conn
+
+    def positions(self, smi):
+        digest = hashlib.blake2b(smi.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def set_bits(self, smi):
+        for p in self.positions(smi):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def maybe_seen(self, smi):
+        for p in self.positions(smi):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __contains__(self, smi):
+        if not self.maybe_seen(smi):
+            return False
+        return self.conn().execute("select 1 from seen where smiles = ?", (smi,)).fetchone() is not None
+
+    def add_many(self, smiles, gen):
+        smiles = list(smiles)
+        conn = self.conn()
+        with conn:
+            conn.executemany("insert or ignore into seen values (?, ?)", ((smi, gen) for smi in smiles))
+        for smi in smiles:
+            self.set_bits(smi)
+
+    def truncate(self, gen):
+        # forget molecules from generations after gen, e.g. when a run is restarted from an earlier generation
+        conn = self.conn()
+        with conn:
+            removed = conn.execute("delete from seen where gen > ?", (gen,)).rowcount
+        if removed > 0:
+            self.rebuild()
+            self.save()
+
+    def add_file(self, file_path, gen, col=-5, chunk_size=100000):
+        # add product smiles from a mutation csv without loading the whole file
+        chunk = []
+        with open(file_path, "r") as f:
+            for line in f:
+                chunk.append(line.rstrip("\n").split(",")[col])
+                if len(chunk) >= chunk_size:
+                    self.add_many(chunk, gen)
+                    chunk = []
+        if chunk:
+            self.add_many(chunk, gen)
+        self.save()
+
+    def save(self):
+        tmp_path = self.bloom_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.bits)
+        os.replace(tmp_path, self.bloom_path)
+
+    def count(self):
+        return self.conn().execute("select count(*) from seen").fetchone()[0]
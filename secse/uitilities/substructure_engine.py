@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 _*-
+"""
+@author: Lu Chong
+@file: substructure_engine.py
+@time: 2026/10/18/21:05
+"""
+from rdkit import Chem, DataStructs
+
+from uitilities.filter_bundle import load_filter_bundle
+
+# engines built in this process, keyed by filter bundle
+_ENGINES = {}
+
+
+def pattern_screen_fp(pattern):
+    # pattern fingerprint of a query, a molecule can only match the query if it has all these bits
+    pattern = Chem.Mol(pattern)
+    pattern.UpdatePropertyCache(strict=False)
+    Chem.FastFindRings(pattern)
+    return Chem.PatternFingerprint(pattern)
+
+
+class MolScan(object):
+    """
+    one molecule going through the engine, its pattern fingerprint is computed once on first use
+    """
+
+    def __init__(self, mol):
+        self.mol = mol
+        self._fp = None
+
+    @property
+    def fp(self):
+        if self._fp is None:
+            self._fp = Chem.PatternFingerprint(self.mol)
+        return self._fp
+
+    def has(self, pattern, screen):
+        return DataStructs.AllProbeBitsMatch(screen, self.fp) and self.mol.HasSubstructMatch(pattern)
+
+    def count(self, pattern, screen, limit):
+        # number of matches, counting stops at limit
+        if not DataStructs.AllProbeBitsMatch(screen, self.fp):
+            return 0
+        return len(self.mol.GetSubstructMatches(pattern, maxMatches=limit))
+
+
+class SubstructureEngine(object):
+    """
+    all filter patterns with their fingerprint prescreen, boolean alerts and count limited patterns
+    are checked in one place
+    """
+
+    def __init__(self, bundle):
+        self.key = bundle["key"]
+        # structure filter patterns in file order, Max 0 means the pattern is not allowed at all
+        self.structure = [(k, v["Pattern_sma"], int(v["Max"]), pattern_screen_fp(v["Pattern_sma"]))
+                          for k, v in bundle["structure"].items()]
+        self.pains = [(k, v, pattern_screen_fp(v)) for k, v in bundle["pains"].items()]
+        self.charge = [(i, pattern_screen_fp(i)) for i in bundle["charge"]]
+        self.rotatable = (bundle["rotatable"], pattern_screen_fp(bundle["rotatable"]))
+        self.rigid = (bundle["rigid"], pattern_screen_fp(bundle["rigid"]))
+
+    def structure_hits(self, scan: MolScan):
+        for k, pattern, max_num, screen in self.structure:
+            if max_num == 0:
+                if scan.has(pattern, screen):
+                    yield k
+            elif scan.count(pattern, screen, max_num + 1) > max_num:
+                yield k
+
+    def structure_failure(self, scan: MolScan):
+        return next(self.structure_hits(scan), "PASS")
+
+    def pains_hit(self, scan: MolScan):
+        return any(scan.has(pattern, screen) for k, pattern, screen in self.pains)
+
+    def charge_counts(self, scan: MolScan):
+        # negative and positive charged atoms, up to 3 each is enough for the charge rules
+        return tuple(scan.count(pattern, screen, 3) for pattern, screen in self.charge)
+
+    def rotatable_num(self, scan: MolScan, limit=1000):
+        return scan.count(self.rotatable[0], self.rotatable[1], limit)
+
+    def rigid_num(self, scan: MolScan, limit=1000):
+        return scan.count(self.rigid[0], self.rigid[1], limit)
+
+
+def get_engine():
+    # build the engine only once per process
+    bundle = load_filter_bundle()
+    if bundle["key"] not in _ENGINES:
+        _ENGINES[bundle["key"]] = SubstructureEngine(bundle)
+    return _ENGINES[bundle["key"]]
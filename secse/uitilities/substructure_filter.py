@@ -5,44 +5,23 @@
 @file: substructure_filter.py 
 @time: 2021/02/08/14:13
 """
-import os
-import pandas as pd
 from rdkit import Chem
 
-FILTER_FILE = "Structure Filter_20211015_v1.12.xls"
+from uitilities.filter_bundle import load_filter_bundle
+from uitilities.substructure_engine import MolScan, get_engine
 
 
 class StructureFilter:
     def __init__(self):
-        df = pd.read_excel(os.path.join(os.getenv("SECSE"), "uitilities", FILTER_FILE),
-                           usecols=["Pattern", "ID", "Max"]).dropna()
-        df = df.set_index("ID")
-        df["Pattern_sma"] = df["Pattern"].apply(lambda x: Chem.MolFromSmarts(x))
-        self.fdic = df[["Pattern_sma", "Max"]].T.to_dict()
+        # patterns are compiled once and shared through the filter bundle
+        self.fdic = load_filter_bundle()["structure"]
+        self.engine = get_engine()
 
-    def sfilter(self, mol):
-        for k, v in self.fdic.items():
-            pattern = v["Pattern_sma"]
-            if int(v["Max"]) == 0:
-                if mol.HasSubstructMatch(pattern):
-                    return k
-            else:
-                mts = mol.GetSubstructMatches(pattern)
-                if len(mts) > int(v['Max']):
-                    return k
-        return "PASS"
+    def sfilter(self, mol, scan=None):
+        return self.engine.structure_failure(scan if scan is not None else MolScan(mol))
 
-    def sfilter_all(self, mol):
-        res = []
-        for k, v in self.fdic.items():
-            pattern = v["Pattern_sma"]
-            if int(v["Max"]) == 0:
-                if mol.HasSubstructMatch(pattern):
-                    res.append(k)
-            else:
-                mts = mol.GetSubstructMatches(pattern)
-                if len(mts) > int(v['Max']):
-                    res.append(k)
+    def sfilter_all(self, mol, scan=None):
+        res = list(self.engine.structure_hits(scan if scan is not None else MolScan(mol)))
         if len(res) == 0:
             return "PASS"
         else:
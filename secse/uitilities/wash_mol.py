@@ -9,6 +9,9 @@
 import random
 from openbabel import openbabel
 from rdkit import Chem
+from rdkit.Chem import rdMolHash
+
+from uitilities.filter_bundle import load_filter_bundle
 
 
 def wash_mol(smi):
@@ -102,13 +105,23 @@ def get_bridged_atoms(mol):
 
 
 def get_rotatable_bound_num(mol):
-    rb_smarts = Chem.MolFromSmarts(
-        '[C^3!D1;!$(C(F)(F)F)]-!@[!Br!F!Cl!I!H3&!$(*#*)!D1;!$([!Br!F!Cl!I](F)(F)F)]')
+    rb_smarts = load_filter_bundle()["rotatable"]
     # sma = '[C^3!D1;!$(C(F)(F)F);!R;!$(C=O(N));!$(NC(=O));!$(C(=O)O);!$(C(=O)O)]-!@[!Br!F!Cl!I!H3&!$(*#*)!D1;!$([!Br!F!Cl!I](F)(F)F);!R;!$(C=O([N,O]));!$(NC(=O));!$(C(=O)O)]'
     return len((mol.GetSubstructMatches(rb_smarts)))
 
 
 def get_rigid_body_num(mol):
-    pattern = "[C^3!D1;!$(C(F)(F)F);!R;!$(C=O(N));!$(NC(=O));!$(C(=O)O);!$(C(=O)O)]-!@[!Br!F!Cl!I!H3&!$(*#*)!D1;!$([!Br!F!Cl!I](F)(F)F);!R;!$(C=O([N,O]));!$(NC(=O));!$(C(=O)O)]"
-    rb = Chem.MolFromSmarts(pattern)
+    rb = load_filter_bundle()["rigid"]
     return len((mol.GetSubstructMatches(rb)))
+
+
+def docking_key(smi):
+    """
+    molecules with the same key give the same species after stereo and tautomer enumeration in LigPrep:
+    protomer/tautomer hash of the stereo stripped molecule
+    """
+    mol = Chem.MolFromSmiles(smi)
+    if mol is None:
+        return smi
+    Chem.RemoveStereochemistry(mol)
+    return rdMolHash.MolHash(mol, rdMolHash.HashFunction.HetAtomProtomer)